@@ -1,3 +1,14 @@
+import ast
+import re
+import threading
+from collections import Counter
+from copy import deepcopy
+from multiprocessing.pool import ThreadPool
+
+from bl.dict import Dict
+from lxml import etree
+
+
 class Converter:
     """abstract base class for converters. Required interface:
     >>> source_obj = "This is a source"           # would usually be an instance of a content class
@@ -9,3 +20,161 @@ class Converter:
         raise NotImplementedError(
             "This method needs to be implemented in %s" % self.__class__.__name__
         )
+
+    def convert_many(self, jobs, workers=None):
+        """convert several sources concurrently in a thread pool (lxml releases the GIL
+        while parsing and transforming). Converters keep their state per call, so they
+        can be used this way; but the params should not share state that depends on the
+        order of conversion, such as the endnotes that are carried between documents.
+        >>> dest_objs = converter.convert_many([(source_obj, params), ...], workers=4)
+        """
+        with ThreadPool(processes=workers) as pool:
+            return pool.starmap(
+                lambda source_obj, params: self.convert(source_obj, **params), jobs
+            )
+
+
+class LazyXSLT:
+    """An XSLT stylesheet that is compiled on first use and then cached, so that importing
+    a converter doesn't compile its stylesheet.
+    >>> transformer_XSLT = LazyXSLT(os.path.splitext(__file__)[0] + ".xsl")
+    >>> root = transformer_XSLT(elem).getroot()     # compiled here, the first time
+
+    compile = the function that compiles the stylesheet from its filename
+    (default: lxml.etree.XSLT).
+    """
+
+    def __init__(self, fn, compile=None):
+        self.fn = fn
+        self.compile = compile or (lambda fn: etree.XSLT(etree.parse(fn)))
+        self.lock = threading.Lock()
+        self.__xslt = None
+
+    @property
+    def xslt(self):
+        if self.__xslt is None:
+            with self.lock:
+                if self.__xslt is None:
+                    self.__xslt = self.compile(self.fn)
+        return self.__xslt
+
+    def __call__(self, *args, **kwargs):
+        return self.xslt(*args, **kwargs)
+
+
+class Transformer:
+    """An XML transformer with match rules (like bxml's XT) that dispatches on the element
+    tag. Rules that match an exact tag (expression="elem.tag=='...'" or "elem.tag in [...]")
+    are found by a dictionary lookup, and only the other rules are evaluated as predicates;
+    rules are still tried in the order in which they were registered, so the first rule that
+    matches an element wins. It is self-contained rather than an XT subclass, so it doesn't
+    depend on the internals of the installed bxml version.
+    >>> transformer = Transformer()
+    >>> @transformer.match("elem.tag=='{%(html)s}p'" % NS)
+    ... def para(elem, **params): ...
+    >>> transformer.counts      # the number of elements handled by each rule
+    Counter({'para': 12, ...})
+
+    (The counts are approximate when the transformer is used from several threads.)
+    """
+
+    TAG_EXPRESSION = re.compile(r"""^\s*elem\.tag\s*==\s*(['"])([^'"]*)\1\s*$""")
+    TAGS_EXPRESSION = re.compile(r"^\s*elem\.tag\s+in\s+(\[.*\])\s*$", re.S)
+
+    def __init__(self):
+        self.matches = []  # the rules, in the order in which they were registered
+        self.dispatch = {}  # tag => the rules that can match elements with that tag
+        self.counts = Counter()
+
+    def match(self, expression=None, xpath=None, namespaces=None):
+        """decorator that registers a transformation function for the elements that match
+        the expression or xpath"""
+
+        def _match(function):
+            self.matches.append(
+                Dict(
+                    expression=expression,
+                    xpath=xpath,
+                    function=function,
+                    namespaces=namespaces,
+                    tags=self.expression_tags(expression) if xpath is None else None,
+                )
+            )
+            self.dispatch = {}
+            return function
+
+        return _match
+
+    @classmethod
+    def expression_tags(C, expression):
+        """the set of tags that an expression matches exactly, or None for a predicate"""
+        if expression is None:
+            return
+        match = C.TAG_EXPRESSION.match(expression)
+        if match is not None:
+            return {match.group(2)}
+        match = C.TAGS_EXPRESSION.match(expression)
+        if match is not None:
+            try:
+                return set(ast.literal_eval(match.group(1)))
+            except (ValueError, SyntaxError):
+                return
+
+    def get_match(self, elem):
+        """for the given elem, return the rule that will be applied"""
+        rules = self.dispatch.get(elem.tag)
+        if rules is None:
+            rules = self.dispatch[elem.tag] = [
+                m for m in self.matches if m.tags is None or elem.tag in m.tags
+            ]
+        for m in rules:
+            if (
+                m.tags is not None
+                or m.expression == "True"
+                or (m.expression is not None and bool(eval(m.expression)))
+                or (
+                    m.xpath is not None
+                    and len(elem.xpath(m.xpath, namespaces=m.namespaces)) > 0
+                )
+            ):
+                self.counts[m.function.__name__] += 1
+                return m
+
+    def __call__(self, elems, **params):
+        """transform the elems with the matching rules"""
+        ee = []
+        if type(elems) != list:
+            elems = [elems]
+        for elem in elems:
+            if type(elem) == str:
+                ee.append(elem)
+            else:
+                m = self.get_match(elem)
+                if m is not None:
+                    ee += m.function(elem, **params) or []
+                else:
+                    ee += self.omit(elem, **params)
+        return [e for e in ee if e is not None]
+
+    def Element(self, elem, **params):
+        """transform a copy of elem (the input is not modified); return the first result"""
+        res = self(deepcopy(elem), **params)
+        if len(res) > 0:
+            return res[0]
+
+    # == COMMON TRANSFORMATION METHODS ==
+
+    def inner_xml(self, elem, with_tail=True, **params):
+        x = [elem.text or ""] + self(elem.getchildren(), **params)
+        if with_tail == True:
+            x += [elem.tail or ""]
+        return x
+
+    def omit(self, elem, keep_tail=True, **params):
+        r = []
+        if keep_tail == True and elem.tail is not None:
+            r += [elem.tail]
+        return r
+
+    def copy(self, elem, **params):
+        return deepcopy(elem)
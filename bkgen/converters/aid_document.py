@@ -4,17 +4,16 @@ import logging
 from copy import deepcopy
 
 from bxml.builder import Builder
-from bxml.xt import XT
 
 from bkgen import NS
 from bkgen.document import Document
 
-from ._converter import Converter
+from ._converter import Converter, Transformer
 
 log = logging.getLogger(__name__)
 B = Builder(default=NS.html, **Document.NS)
 H = B._
-transformer = XT()
+transformer = Transformer()
 
 
 class AidDocument(Converter):
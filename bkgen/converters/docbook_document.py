@@ -6,18 +6,16 @@ from copy import deepcopy
 
 from bl.url import URL
 from bxml.builder import Builder
-from bxml.xt import XT
-from lxml import etree
 
 from bkgen import NS
 from bkgen.document import Document
 
-from ._converter import Converter
+from ._converter import Converter, LazyXSLT, Transformer
 
 log = logging.getLogger(__name__)
 B = Builder(default=NS.html, **NS)
-transformer = XT()
-transformer_XSLT = etree.XSLT(etree.parse(os.path.splitext(__file__)[0] + ".xsl"))
+transformer = Transformer()
+transformer_XSLT = LazyXSLT(os.path.splitext(__file__)[0] + ".xsl")
 
 
 class DocBookDocument(Converter):
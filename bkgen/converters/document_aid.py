@@ -3,6 +3,7 @@
 import logging
 import os
 import re
+from multiprocessing.pool import ThreadPool
 
 from bf.css import CSS
 from bl.file import File
@@ -10,18 +11,18 @@ from bl.folder import Folder
 from bl.url import URL
 from bxml.builder import Builder
 from bxml.xml import XML
-from bxml.xt import XT
 from lxml import etree
 
 from bkgen import NS, config
 from bkgen.document import Document
+from bkgen.includes import Includes
 
-from ._converter import Converter
+from ._converter import Converter, LazyXSLT, Transformer
 
 B = Builder(**NS)
 H = Builder.single(NS.html)
-transformer = XT()
-transformer_XSLT = etree.XSLT(etree.parse(os.path.splitext(__file__)[0] + ".xsl"))
+transformer = Transformer()
+transformer_XSLT = LazyXSLT(os.path.splitext(__file__)[0] + ".xsl")
 
 log = logging.getLogger(__name__)
 logging.basicConfig(**config.Logging)
@@ -29,6 +30,10 @@ logging.basicConfig(**config.Logging)
 
 class DocumentAid(Converter):
     def convert(self, document, **params):
+        """
+        Convert the document to InDesign tagged XML. The referenced images are written to a
+        folder next to the output, in a thread pool of workers threads.
+        """
         doc = document.transform(transformer, **params)
         return doc
 
@@ -52,24 +57,23 @@ def default(elem, **params):
     return [root]
 
 
-def get_includes(root, **params):
+def get_includes(root, includes=None, include_chain=None, **params):
     """
     Place the content from `<pub:include/>` elements, and remap src and href attributes.
+    includes = the Includes resolver to use (shared by the documents in a build).
     """
     document = params.get("xml")
+    includes = includes or Includes()
+    chain = include_chain or [(os.path.abspath(document.fn), None)]
     for incl in root.xpath(".//pub:include", namespaces=NS):
         for ch in incl:
             incl.remove(ch)
-        srcfn = os.path.join(document.path, str(URL(incl.get("src"))).split("#")[0])
+        srcfn, srcid = Includes.src_fn_id(document.fn, incl.get("src"))
         log.debug(srcfn)
         assert os.path.exists(srcfn), f"NOT FOUND: {srcfn}"
-        src = Document(fn=srcfn)
-        if "#" in incl.get("src"):
-            srcid = str(URL(incl.get("src"))).split("#")[-1]
-            elems = XML.xpath(src.root, "//*[@id='%s']" % srcid)
-        else:
-            elems = XML.xpath(src.root, "html:body/*", namespaces=NS)
-        for elem in elems:
+        src = includes.document(srcfn)
+        elems = includes.elements(srcfn, srcid, fn=document.fn, chain=chain)
+        for elem in elems or []:
             for href_elem in Document.xpath(elem, ".//*[@href]"):
                 url = URL(href_elem.get("href"))
                 if url.scheme in ["", "file"]:
@@ -83,7 +87,12 @@ def get_includes(root, **params):
                     url.path = os.path.relpath(hrfile.fn, document.path)
                 img.set("src", str(url))
             if len(elem.xpath(".//pub:include", namespaces=NS)) > 0:
-                elem = get_includes(elem, **params)
+                elem = get_includes(
+                    elem,
+                    includes=includes,
+                    include_chain=chain + [(srcfn, srcid)],
+                    **params,
+                )
             incl.append(elem)
     return root
 
@@ -149,9 +158,14 @@ def paragraph_returns(root, **params):
     span or other element at the end of the paragraph (which would cause InDesign to ignore the
     paragraph return if it were after that element).
     """
-    t = etree.tounicode(root).strip()
-    t = re.sub(r"\s*\n\s*", "", t)
-    root = etree.fromstring(t)
+    # remove the whitespace around line breaks in the text, so that the only line breaks are
+    # the paragraph returns.
+    for node in root.iter():
+        if isinstance(node.tag, str) and node.text and "\n" in node.text:
+            node.text = re.sub(r"\s*\n\s*", "", node.text) or None
+        if node.tail and "\n" in node.tail:
+            node.tail = re.sub(r"\s*\n\s*", "", node.tail) or None
+    root.tail = None
     match_elements_to_paragraph_return = """
         (name()='p' or name()='li' or name()='dd'
         or name()='h1' or name()='h2' or name()='h3' 
@@ -216,13 +230,20 @@ def table_column_widths(root):
     return root
 
 
-def output_images(root, art_path=None, **params):
-    """get any referenced images and write them to the output folder"""
+def output_images(root, art_path=None, workers=None, **params):
+    """
+    get any referenced images and write them to the output folder.
+    The images are copied in a thread pool (workers threads), each output image once. Source
+    images with the same name in different folders are given distinct output names.
+    """
     src_file = params["xml"]
     out_file = File(fn=params["fn"])
     out_filebase = os.path.splitext(out_file.basename)[0]
     if ".aid" in out_filebase:
         out_filebase = os.path.splitext(out_filebase)[0]
+    images = {}  # out_image.fn => (src_image, out_image)
+    out_images = {}  # src_image.fn => out_image
+    out_fns = set()  # the output filenames that are taken
     for img in Document.xpath(root, "//html:img[@src]"):
         src_url = URL(img.get("src"))
         if src_url.scheme in ["", "file"] and src_url.path[0:1] != "/":
@@ -233,17 +254,44 @@ def output_images(root, art_path=None, **params):
         if not src_image.exists and art_image.exists:
             src_image = art_image
 
-        out_image = out_file.folder / out_filebase / src_image.basename
+        if src_image.fn in out_images:
+            out_image = out_images[src_image.fn]
+        else:
+            out_image = out_file.folder / out_filebase / src_image.basename
+            stem, ext = os.path.splitext(src_image.basename)
+            n = 1
+            while out_image.fn in out_fns:
+                n += 1
+                out_image = (
+                    out_file.folder / out_filebase / ("%s-%d%s" % (stem, n, ext))
+                )
+            if n > 1:
+                log.warning(
+                    f"img src {src_image.fn} has the same name as another image: "
+                    + f"writing {out_image.fn}"
+                )
+            out_images[src_image.fn] = out_image
+            out_fns.add(out_image.fn)
 
         if not src_image.exists:
             if not out_image.exists:
                 log.warn(f"img src doesn't exists: {src_image.fn}")
                 log.debug(dict(**src_url))
-        elif not out_image.exists or src_image.mtime > out_image.mtime:
-            src_image.write(fn=out_image.fn)
-            log.info(f"wrote image file: {out_image.fn}")
+        else:
+            images.setdefault(out_image.fn, (src_image, out_image))
 
         out_relpath = out_image.relpath(out_file.path)
         if out_relpath != img.get("src"):
             img.set("src", out_relpath)
             img.set("href", f"file://{out_relpath}")
+
+    if len(images) > 0:
+        with ThreadPool(processes=workers) as pool:
+            pool.starmap(output_image, [images[fn] for fn in sorted(images)])
+
+
+def output_image(src_image, out_image):
+    """copy the src_image to out_image, unless out_image is up to date"""
+    if not out_image.exists or src_image.mtime > out_image.mtime:
+        src_image.write(fn=out_image.fn)
+        log.info(f"wrote image file: {out_image.fn}")
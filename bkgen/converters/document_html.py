@@ -2,8 +2,11 @@
 
 import logging
 import os
+import re
 from copy import deepcopy
+from functools import lru_cache
 
+from bl.dict import Dict
 from bl.file import File
 from bl.url import URL
 from bxml.builder import Builder
@@ -15,19 +18,20 @@ from bkgen import NS
 from bkgen.document import Document
 from bkgen.html import HTML
 
-from ._converter import Converter
+from ._converter import Converter, LazyXSLT
 
 log = logging.getLogger(__name__)
 
 B = Builder(default=NS.html, **{"html": NS.html, "pub": NS.pub})
 H = Builder.single(NS.html)
 transformer = XT()
-transformer_XSLT = etree.XSLT(etree.parse(os.path.splitext(__file__)[0] + ".xsl"))
+transformer_XSLT = LazyXSLT(os.path.splitext(__file__)[0] + ".xsl")
 
 
 class DocumentHtml(Converter):
     def convert(self, document, **params):
-        document.render_includes()
+        document.render_includes(includes=params.get("includes"))
+        params.setdefault("source_fn", document.fn)
         root = transformer.transform(document.root, XMLClass=HTML, **params)
         doc = HTML(root=root)
         # doc.fn = os.path.splitext(document.fn)[0] + '.html'
@@ -41,20 +45,107 @@ def default(elem, **params):
     root = transformer_XSLT(elem).getroot()
     root = html_lang(root, **params)
     root = fill_head(root, **params)
-    root = filter_conditions(root, **params)
-    root = omit_unsupported_font_formatting(root, **params)
-    root = render_footnotes(root, **params)
-    root = process_endnotes(root, **params)
-    root = process_pub_attributes(root, **params)
-    root = render_crossrefs(root)
-    root = process_index_entries(root, **params)
-    root = replace_ligature_characters(root)
-    if params.get("simple_tables") is True:
+    # element-local processing, in a single traversal
+    root, tags = process_elements(root, **params)
+    # the order-dependent steps, only where they are needed
+    if "{%(pub)s}footnote" % NS in tags:
+        root = render_footnotes(root, **params)
+    if tags & ENDNOTE_TAGS or len(params.get("endnotes") or []) > 0:
+        root = process_endnotes(root, **params)
+    if "{%(pub)s}crossref" % NS in tags:
+        root = render_crossrefs(root, **params)
+    root = replace_ligature_characters(root, **params)
+    if params.get("simple_tables") is True and "{%(html)s}table" % NS in tags:
         root = render_simple_tables(root)
-    root = tds_with_image_style_min_width_height(root)
     return root
 
 
+ENDNOTE_TAGS = {"{%(pub)s}endnote" % NS, "{%(pub)s}endnotes" % NS}
+SPAN_SUPPORTED_KEYS = [
+    "class",
+    "id",
+    "style",
+    "{%(epub)s}type" % NS,
+    "title",
+    "role",
+    "aria-labelledby",
+    "aria-label",
+]
+
+
+def process_elements(root, **params):
+    """
+    Do the element-local post-processing in a single traversal of the tree, with the
+    same results as filter_conditions(), omit_unsupported_font_formatting(),
+    process_pub_attributes(), process_index_entries(), and
+    tds_with_image_style_min_width_height().
+    Returns (root, tags), where tags is the set of element tags in the result.
+    """
+    include = (params.get("conditions") or "digital html epub mobi").lower().split(" ")
+    cond_key, condlink_key = "{%(pub)s}cond" % NS, "{%(pub)s}condlink" % NS
+    html_prefix, pub_prefix = "{%(html)s}" % NS, "{%(pub)s}" % NS
+    span_tag, td_tag, xe_tag = (
+        html_prefix + "span",
+        html_prefix + "td",
+        pub_prefix + "xe",
+    )
+    tags = set()
+    tds = []
+    stack = [root]
+    while len(stack) > 0:
+        elem = stack.pop()
+        is_html = elem.tag.startswith(html_prefix)
+        # filter_conditions
+        if is_html and cond_key in elem.attrib:
+            conditions = elem.attrib.pop(cond_key).lower().split(" ")
+            if not any(condition in include for condition in conditions):
+                XML.remove(elem)
+                continue
+        if is_html and condlink_key in elem.attrib:
+            link_elem = XML.find(elem, "ancestor-or-self::html:*[@href]", namespaces=NS)
+            if link_elem is not None:
+                conditions = elem.attrib.pop(condlink_key).lower().split(" ")
+                if not any(condition in include for condition in conditions):
+                    if link_elem is elem:
+                        # its children are re-parented; they are already on the stack
+                        stack.extend(reversed(list(elem.iterchildren(etree.Element))))
+                        XML.replace_with_contents(elem)
+                        continue
+                    XML.replace_with_contents(link_elem)
+        # process_index_entries
+        if elem.tag == xe_tag:
+            elem.tag = span_tag
+            for key in [k for k in elem.attrib.keys() if k != "id"]:
+                _ = elem.attrib.pop(key)
+            elem.set("class", "xe")
+        # omit_unsupported_font_formatting
+        elif elem.tag == span_tag:
+            for key in [k for k in elem.attrib.keys() if k not in SPAN_SUPPORTED_KEYS]:
+                _ = elem.attrib.pop(key)
+        # process_pub_attributes
+        pub_keys = [k for k in elem.attrib.keys() if k.startswith(pub_prefix)]
+        if len(pub_keys) > 0:
+            styles = [
+                s.strip()
+                for s in (elem.get("style") or "").split(";")
+                if s.strip() != ""
+            ]
+            for key in pub_keys:
+                styles.append(
+                    "%s:%s" % (key.replace(pub_prefix, "-pub-"), elem.get(key))
+                )
+                _ = elem.attrib.pop(key)
+            elem.set("style", "; ".join(styles))
+        if elem.tag == td_tag:
+            tds.append(elem)
+        tags.add(elem.tag)
+        stack.extend(reversed(list(elem.iterchildren(etree.Element))))
+    # tds_with_image_style_min_width_height, once the img styles are final
+    for td in tds:
+        td_with_image_style_min_width_height(td)
+    return root, tags
+
+
 def html_lang(root, lang="en", **params):
     """make sure the html sets lang and xml:lang"""
     if root.get("lang") is None and lang is not None:
@@ -63,7 +154,7 @@ def html_lang(root, lang="en", **params):
     return root
 
 
-def fill_head(root, **params):
+def fill_head(root, ids=None, **params):
     head = XML.find(root, "//html:head", namespaces=NS)
     output_path = params.get("output_path") or os.path.dirname(params.get("fn"))
     if head is not None:
@@ -104,7 +195,8 @@ def fill_head(root, **params):
                 root, "html:body/html:*/@aria-labelledby", namespaces=NS
             )
             if labelledby is not None:
-                title_elem = XML.find(root, "//*[@id='%s']" % labelledby)
+                ids = ids if ids is not None else id_index(root)
+                title_elem = ids.get(labelledby)
                 if title_elem is not None:
                     title = H.title(
                         etree.tounicode(title_elem, method="text", with_tail=False)
@@ -184,12 +276,34 @@ def omit_unsupported_font_formatting(root, **params):
     return root
 
 
-def render_footnotes(root, **params):
-    """render the footnotes within the given section at the end of the section"""
-    sections = root.xpath(
-        ".//html:section[@id and descendant::pub:footnote]", namespaces=NS
-    )
-    for section in sections:
+def render_footnotes(
+    root, footnote_numbering="section", footnote_counter=None, **params
+):
+    """render the footnotes within the given section at the end of the section.
+    footnote_numbering says where the footnote numbers restart:
+    * "section" (the default): in each section that has footnotes
+    * "document": in each document
+    * "book": never -- the count is kept in footnote_counter (a Dict with a count),
+        which is passed to each document in the book.
+    """
+    if footnote_numbering == "book":
+        counter = footnote_counter if footnote_counter is not None else Dict(count=0)
+    else:
+        counter = Dict(count=0)
+    section_tag = "{%(html)s}section" % NS
+    fnref_tag = "{%(pub)s}footnote-ref" % NS
+
+    # each footnote belongs to the outermost section with an @id that contains it
+    section_footnotes = {}
+    for footnote in root.iter("{%(pub)s}footnote" % NS):
+        section = None
+        for ancestor in footnote.iterancestors(section_tag):
+            if ancestor.get("id") is not None:
+                section = ancestor
+        if section is not None:
+            section_footnotes.setdefault(section, []).append(footnote)
+
+    for section, footnotes in section_footnotes.items():
         footnotes_section = XML.find(
             section, ".//html:section[@class='footnotes']", namespaces=NS
         )
@@ -199,48 +313,47 @@ def render_footnotes(root, **params):
             )
             footnotes_section.tail = "\n"
             section.append(footnotes_section)
+        if footnote_numbering == "section":
+            counter.count = 0
 
-        section_footnotes = XML.xpath(section, ".//pub:footnote", namespaces=NS)
-        for footnote in section_footnotes:
-            parent = footnote.getparent()
-            fnum = footnote.get("title") or str(section_footnotes.index(footnote) + 1)
+        for footnote in footnotes:
+            counter.count += 1
+            fnum = footnote.get("title") or str(counter.count)
             fnid = footnote.get("id") or "fn-%s" % fnum
+            fnref = next(footnote.iter(fnref_tag), None)
             fnrefid = (
-                XML.find(footnote, "pub:footnote-ref/@id", namespaces=NS)
-                or fnid + "ref"
-            )
+                fnref is not None and fnref.getparent() is footnote and fnref.get("id")
+            ) or fnid + "ref"
             fnlink = H.a(fnum, {"href": "#%s" % fnid, "id": fnrefid})
-            parent.insert(parent.index(footnote), fnlink)
-            XML.remove(footnote, leave_tail=True)
-            fnref = XML.find(footnote, ".//pub:footnote-ref", namespaces=NS)
+            fnlink.tail, footnote.tail = footnote.tail, None
+            footnote.addprevious(fnlink)
             fnreflink = H.a(fnum, {"href": "#%s" % fnrefid})
             if fnref is not None:
+                fnreflink.tail = fnref.tail
                 fnref.getparent().replace(fnref, fnreflink)
             else:
                 firstp = XML.find(footnote, "html:p", namespaces=NS)
                 firstp.insert(0, fnreflink)
                 firstp.text, fnreflink.tail = "", firstp.text or ""
             footnotes_section.append(footnote)
-            footnote.tag = "{%(html)s}section" % NS
+            footnote.tag = section_tag
             footnote.set("class", "footnote")
-        if len(footnotes_section.getchildren()) == 0:
+        if len(footnotes_section) == 0:
             XML.remove(footnotes_section)
     return root
 
 
-def process_endnotes(root, endnotes=[], insert_endnotes=False, **params):
+def process_endnotes(root, endnotes=None, insert_endnotes=False, **params):
     """collect endnotes from the content in params['endnotes'],
     and output them at <pub:endnotes/> or existing <section class="endnotes"/>.
     If insert_endnotes=True, then insert any remaining endnotes at the end of the document.
+    (To carry endnotes from one document to the next, pass the same endnotes list.)
     """
-    endnote_xpaths = ["pub:endnote", "pub:endnotes", "html:section[@class='endnotes']"]
-    elem = XML.find(root, "|".join(["//" + x for x in endnote_xpaths]), namespaces=NS)
-    while elem is not None:
-        if elem.tag == "{%(pub)s}endnotes" % NS or (
-            elem.tag == "{%(html)s}section" % NS and elem.get("class") == "endnotes"
-        ):
+    endnotes = endnotes if endnotes is not None else []
+    for elem in endnote_elements(root):
+        if elem.tag == "{%(pub)s}endnotes" % NS or elem.tag == "{%(html)s}section" % NS:
             # render the collected endnotes here
-            this_elem = render_endnotes(elem, endnotes)
+            render_endnotes(elem, endnotes)
         else:
             # render the endnote reference link here and collect the endnote
             enum = elem.get("title") or str(len(endnotes) + 1)
@@ -255,21 +368,15 @@ def process_endnotes(root, endnotes=[], insert_endnotes=False, **params):
             )
             for e in elem.getchildren():
                 endnote.append(e)
+            enlink.tail = elem.tail
             elem.getparent().replace(elem, enlink)
             enref = XML.find(endnote, ".//pub:endnote-ref", namespaces=NS)
-            enref.getparent().replace(enref, enreflink)
-            endnote = etree.fromstring(
-                etree.tounicode(endnote).replace(
-                    ' xmlns:pub="http://publishingxml.org/ns"', ""
-                )
-            )
+            if enref is not None:
+                enreflink.tail = enref.tail
+                enref.getparent().replace(enref, enreflink)
+            # the endnote no longer needs the pub namespace declaration
+            etree.cleanup_namespaces(endnote)
             endnotes.append(endnote)
-            this_elem = enlink
-        elem = XML.find(
-            this_elem,
-            "|".join(["following::" + x for x in endnote_xpaths]),
-            namespaces=NS,
-        )
     if insert_endnotes is True and len(endnotes) > 0:
         body = XML.find(root, "html:body", namespaces=NS)
         if body is None:
@@ -278,6 +385,24 @@ def process_endnotes(root, endnotes=[], insert_endnotes=False, **params):
     return root
 
 
+def endnote_elements(root):
+    """
+    The endnotes (<pub:endnote>) and endnote insertion points (<pub:endnotes>,
+    <section class="endnotes">) in root, in document order, collected in one traversal.
+    The content of these elements is not searched.
+    """
+    elems = []
+    for elem in root.iter(
+        "{%(pub)s}endnote" % NS, "{%(pub)s}endnotes" % NS, "{%(html)s}section" % NS
+    ):
+        if elem.tag == "{%(html)s}section" % NS and elem.get("class") != "endnotes":
+            continue
+        if len(elems) > 0 and any(e is elems[-1] for e in elem.iterancestors()):
+            continue
+        elems.append(elem)
+    return elems
+
+
 def render_endnotes(endnotes_elem, endnotes):
     """insert the collected endnotes into the given endnotes_elem"""
     if endnotes_elem.tag != "{%(html)s}section" % NS:
@@ -306,19 +431,55 @@ def process_pub_attributes(root, **params):
     return root
 
 
-def render_crossrefs(root):
-    """pub:crossref uses xpath to select content"""
-    for crossref in Document.xpath(root, "//pub:crossref"):
+def render_crossrefs(root, ids=None, crossref_target=None, **params):
+    """pub:crossref uses xpath to select content.
+    * ids = the id_index() of root, built here if not given; used for the srcs in this
+        document (#id, or a path to params['source_fn'])
+    * crossref_target = a function (src, source_fn) that returns the target element of
+        crossrefs whose target is not in root, such as Project.crossref_target
+    """
+    ids = ids if ids is not None else id_index(root)
+    source_fn = params.get("source_fn")
+    for crossref in list(root.iter("{%(pub)s}crossref" % NS)):
         log.debug("pub:crossref: %r" % crossref.attrib)
-        src_id = crossref.get("src").split("#")[-1]
-        src_elem = Document.find(root, "//*[@id='%s']" % src_id)
+        path, src_id = (["", ""] + crossref.get("src").split("#"))[-2:]
+        # an id in another document is not looked up here: generated ids can repeat
+        if path == "" or (
+            source_fn is not None
+            and os.path.abspath(os.path.join(os.path.dirname(source_fn), path))
+            == os.path.abspath(source_fn)
+        ):
+            src_elem = ids.get(src_id)
+        else:
+            src_elem = None
+        if src_elem is None and crossref_target is not None:
+            src_elem = crossref_target(crossref.get("src"), params.get("source_fn"))
         if src_elem is not None:
-            crossref.text = Document.find(src_elem, crossref.get("select"))
+            result = crossref_xpath(crossref.get("select"))(src_elem)
+            if isinstance(result, list):
+                result = result[0] if len(result) > 0 else None
+            if isinstance(result, etree._Element):
+                result = etree.tounicode(result, method="text", with_tail=False)
+            crossref.text = str(result) if result is not None else None
         log.debug("select: %s" % crossref.text)
         Document.replace_with_contents(crossref)
     return root
 
 
+def id_index(root):
+    """{id: element} for the elements in root that have an @id (the first, if repeated)"""
+    ids = {}
+    for elem in root.xpath("//*[@id]"):
+        ids.setdefault(elem.get("id"), elem)
+    return ids
+
+
+@lru_cache(maxsize=None)
+def crossref_xpath(select):
+    """the compiled XPath for a crossref select expression"""
+    return etree.XPath(select, namespaces=Document.NS)
+
+
 def process_index_entries(root, **params):
     """replace index entries (pub:xe) with spans"""
     for e in Document.xpath(root, "//pub:xe"):
@@ -329,46 +490,72 @@ def process_index_entries(root, **params):
     return root
 
 
-def replace_ligature_characters(root):
+# ligature characters and their multi-character equivalents
+LIGATURES = {
+    "\uA732": "AA",
+    "\uA733": "aa",
+    "\u00C6": "AE",
+    "\u00E6": "ae",
+    "\uA734": "AO",
+    "\uA735": "ao",
+    "\uA736": "AU",
+    "\uA737": "au",
+    "\uA738": "AV",
+    "\uA739": "av",
+    "\uA73C": "AY",
+    "\uA73D": "ay",
+    "\uFB00": "ff",
+    "\uFB03": "ffi",
+    "\uFB04": "ffl",
+    "\uFB01": "fi",
+    "\uFB02": "fl",
+    "\u0152": "OE",
+    "\u0153": "oe",
+    "\uA74E": "OO",
+    "\uA74F": "oo",
+    "\u00DF": "fs",
+    "\uFB06": "st",
+    "\uA728": "TZ",
+    "\uA729": "tz",
+    "\u1D6B": "ue",
+    "\uA760": "VY",
+    "\uA761": "vy",
+}
+
+
+@lru_cache(maxsize=None)
+def ligatures_table(keep_ligatures=None):
     """
-    Sometimes ligature characters (fl, fi) are used in books directly,
-    but these don't work well in HTML contexts,
-    so replace them with their multi-character equivalents.
+    (translation table, regex matching the characters to translate) for the LIGATURES,
+    except those in the string keep_ligatures
     """
     ligatures = {
-        "\uA732": "AA",
-        "\uA733": "aa",
-        "\u00C6": "AE",
-        "\u00E6": "ae",
-        "\uA734": "AO",
-        "\uA735": "ao",
-        "\uA736": "AU",
-        "\uA737": "au",
-        "\uA738": "AV",
-        "\uA739": "av",
-        "\uA73C": "AY",
-        "\uA73D": "ay",
-        "\uFB00": "ff",
-        "\uFB03": "ffi",
-        "\uFB04": "ffl",
-        "\uFB01": "fi",
-        "\uFB02": "fl",
-        "\u0152": "OE",
-        "\u0153": "oe",
-        "\uA74E": "OO",
-        "\uA74F": "oo",
-        "\u00DF": "fs",
-        "\uFB06": "st",
-        "\uA728": "TZ",
-        "\uA729": "tz",
-        "\u1D6B": "ue",
-        "\uA760": "VY",
-        "\uA761": "vy",
+        lig: chars
+        for lig, chars in LIGATURES.items()
+        if lig not in (keep_ligatures or "")
     }
-    text = etree.tounicode(root)
-    for lig, chars in ligatures.items():
-        text = text.replace(lig, chars)
-    root = etree.fromstring(text)
+    return (
+        str.maketrans(ligatures),
+        re.compile("[%s]" % "".join(ligatures.keys()) if ligatures else "(?!)"),
+    )
+
+
+def replace_ligature_characters(root, keep_ligatures=None, **params):
+    """
+    Sometimes ligature characters (fl, fi) are used in books directly,
+    but these don't work well in HTML contexts,
+    so replace them with their multi-character equivalents (in the text content).
+    keep_ligatures is a string of ligature characters to leave in place (for example,
+    "ß" in German content).
+    """
+    table, ligatures_regex = ligatures_table(keep_ligatures)
+    if ligatures_regex.search("".join(root.itertext())) is None:
+        return root
+    for elem in root.iter():
+        if elem.text and ligatures_regex.search(elem.text):
+            elem.text = elem.text.translate(table)
+        if elem.tail and ligatures_regex.search(elem.tail):
+            elem.tail = elem.tail.translate(table)
     return root
 
 
@@ -413,36 +600,41 @@ def tds_with_image_style_min_width_height(root):
         root,
         "//html:td[descendant::html:img[contains(@style,'width') or contains(@style,'height')]]",
     ):
-        td_style = {
-            key.strip(): val.strip()
-            for key, val in [
-                attr.split(":")
-                for attr in (td.get("style") or ":").strip(";").split(";")
-            ]
-            if key != ""
-        }
-        for img in Document.xpath(
-            td,
-            "descendant::html:img[contains(@style,'width') or contains(@style,'height')]",
-        ):
-            img_style = {
+        td_with_image_style_min_width_height(td)
+    return root
+
+
+def td_with_image_style_min_width_height(td):
+    td_style = None
+    for img in td.iter("{%(html)s}img" % NS):
+        img_style = img.get("style") or ""
+        if "width" not in img_style and "height" not in img_style:
+            continue
+        if td_style is None:
+            td_style = {
                 key.strip(): val.strip()
                 for key, val in [
                     attr.split(":")
-                    for attr in (img.get("style") or ":").strip(";").split(";")
+                    for attr in (td.get("style") or ":").strip(";").split(";")
                 ]
                 if key != ""
             }
-            for key in ["width", "height"]:
-                if key in img_style and "min-" + key not in td_style:
-                    td_style["min-" + key] = img_style[key]
-            for key in ["min-width", "min-height"]:
-                if key in img_style and key not in td_style:
-                    td_style[key] = img_style[key]
-        if len(td_style) > 0:
-            td.set(
-                "style",
-                "; ".join(["%s: %s" % (k, v) for k, v in td_style.items()]) + ";",
-            )
-
-    return root
+        img_style = {
+            key.strip(): val.strip()
+            for key, val in [
+                attr.split(":") for attr in (img_style or ":").strip(";").split(";")
+            ]
+            if key != ""
+        }
+        for key in ["width", "height"]:
+            if key in img_style and "min-" + key not in td_style:
+                td_style["min-" + key] = img_style[key]
+        for key in ["min-width", "min-height"]:
+            if key in img_style and key not in td_style:
+                td_style[key] = img_style[key]
+    if td_style is not None and len(td_style) > 0:
+        td.set(
+            "style",
+            "; ".join(["%s: %s" % (k, v) for k, v in td_style.items()]) + ";",
+        )
+    return td
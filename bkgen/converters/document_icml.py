@@ -1,34 +1,227 @@
+import hashlib
 import json
 import os
 import re
 import urllib.parse
+from contextlib import contextmanager
+from copy import deepcopy
 from glob import glob
 
 from bl.dict import Dict
-from bl.id import random_id
+from bl.id import alpha_chars, alphanum_chars, random_id
 from bl.string import String
 from bl.url import URL
 from bxml.builder import Builder
 from bxml.xml import XML
-from bxml.xt import XT
 from lxml import etree
 
 from bkgen import NS, config
 from bkgen.icml import ICML
 
-from ._converter import Converter
+from ._converter import Converter, LazyXSLT, Transformer
 
 B = Builder(**NS)
 E = Builder()._
-transformer = XT()
-transformer_XSLT = etree.XSLT(etree.parse(os.path.splitext(__file__)[0] + ".xsl"))
+transformer = Transformer()
+transformer_XSLT = LazyXSLT(os.path.splitext(__file__)[0] + ".xsl")
 
 
 class DocumentIcml(Converter):
-    def convert(self, document, **params):
-        document.render_includes(strip=True)
+    def convert(self, document, deterministic_ids=False, **params):
+        """
+        deterministic_ids=False: If True, the Self ids in the ICML are derived from the
+            document filename and their sequence, rather than random, so that each export
+            of the same document is identical.
+        """
+        document.render_includes(strip=True, includes=params.get("includes"))
+        if deterministic_ids is True and params.get("ids") is None:
+            params["ids"] = Ids(os.path.basename(document.fn or ""))
         return document.transform(transformer, XMLClass=ICML, **params)
 
+    def convert_chapters(self, document, path=None, **params):
+        """
+        Export the document as one .icml file per chapter, written incrementally to path
+        (default: the document's folder), and return the list of filenames. Each top-level
+        section is a chapter, and so is each run of body content between the sections.
+        The chapters are converted one at a time, so only one chapter's output is in memory
+        at once (the conversion is Python code that holds the GIL, so converting them in
+        threads would not be faster). A link to an anchor in another chapter is made to a
+        cross-document destination: the anchor's HyperlinkTextDestination and the
+        Hyperlink have the same DestinationUniqueKey. Endnotes that are carried from one chapter to the next (to an
+        insert_endnotes in a later chapter) are placed there; any that remain are written
+        to one <basename>_Endnotes.xml document.
+        """
+        document.render_includes(strip=True, includes=params.get("includes"))
+        path = path or os.path.dirname(os.path.abspath(document.fn))
+        basename = os.path.splitext(os.path.basename(document.fn))[0]
+        chapters = []
+        for elem in document.root.xpath("html:body/*", namespaces=NS):
+            if elem.tag == "{%(html)s}section" % NS or len(chapters) == 0:
+                chapters.append([elem])
+            elif chapters[-1][0].tag == "{%(html)s}section" % NS:
+                chapters.append([elem])
+            else:
+                chapters[-1].append(elem)
+        fns = [
+            os.path.join(path, "%s_%02d.icml" % (basename, i + 1))
+            for i in range(len(chapters))
+        ]
+
+        # the chapter file and the DestinationUniqueKey of each anchor in the document
+        chapter_anchors = Dict()
+        for i in range(len(chapters)):
+            for elem in chapters[i]:
+                for a in elem.iter(
+                    "{%(pub)s}anchor_start" % NS, "{%(pub)s}anchor_end" % NS
+                ):
+                    name = a.get("name") + ("_end" if a.tag.endswith("_end") else "")
+                    if name not in chapter_anchors:
+                        chapter_anchors[name] = Dict(
+                            filename=os.path.basename(fns[i]),
+                            key=str(len(chapter_anchors) + 1),
+                        )
+
+        # endnotes are numbered in the whole document, so each chapter starts its numbering
+        # where the preceding chapters left off.
+        endnotes_before = [0]
+        for elems in chapters[:-1]:
+            endnotes_before.append(
+                endnotes_before[-1]
+                + sum(
+                    len(elem.xpath(".//pub:endnote", namespaces=NS)) for elem in elems
+                )
+            )
+
+        params.pop("carry_endnotes", None)
+        mutable = params.pop("mutable", None) or Dict()
+        mutable.Endnotes = mutable.get("Endnotes") or []
+        for i in range(len(chapters)):
+            with chapter_document(
+                document, chapters[i], fns[i], endnotes_before=endnotes_before[i]
+            ) as chapter:
+                icml = self.convert(
+                    chapter,
+                    fn=fns[i],
+                    mutable=mutable,
+                    carry_endnotes=True,
+                    chapter_anchors=chapter_anchors,
+                    **params
+                )
+            write_icml(icml.root, fns[i])
+            del icml
+        if len(mutable.Endnotes) > 0:
+            ids = params.get("ids")
+            if ids is None and params.get("deterministic_ids") is True:
+                ids = Ids(basename + "_Endnotes.xml")
+            write_endnotes(
+                mutable.Endnotes,
+                os.path.join(path, basename + "_Endnotes.xml"),
+                ids=ids,
+            )
+            mutable.Endnotes = []
+        return fns
+
+
+@contextmanager
+def chapter_document(document, elems, fn, endnotes_before=0):
+    """
+    A Document with a copy of the document's head (etc.) and the elems in its body. The
+    elems are moved into the chapter rather than copied, and are put back in the document
+    on exit. endnotes_before = the number of endnotes in the document before the elems.
+    """
+    from bkgen.document import Document
+
+    root = etree.Element(
+        document.root.tag, document.root.attrib, nsmap=document.root.nsmap
+    )
+    root.text = document.root.text
+    for ch in document.root:
+        if ch.tag == "{%(html)s}body" % NS:
+            body = etree.SubElement(root, ch.tag, ch.attrib)
+            body.text, body.tail = ch.text, ch.tail
+        else:
+            root.append(deepcopy(ch))
+    source_body, following = elems[0].getparent(), elems[-1].getnext()
+    endnote_starts = {}  # section => its original endnote_start
+    for elem in elems:
+        body.append(elem)
+        if (
+            elem.tag == "{%(html)s}section" % NS
+            and endnotes_before > 0
+            and elem.get("endnote_renum") != "eachSect"
+        ):
+            endnote_starts[elem] = elem.get("endnote_start")
+            elem.set(
+                "endnote_start",
+                str(int(elem.get("endnote_start") or "1") + endnotes_before),
+            )
+    try:
+        yield Document(root=root, fn=os.path.splitext(fn)[0] + ".xml")
+    finally:
+        for section, endnote_start in endnote_starts.items():
+            if endnote_start is None:
+                section.attrib.pop("endnote_start")
+            else:
+                section.set("endnote_start", endnote_start)
+        for elem in elems:
+            if following is not None:
+                following.addprevious(elem)
+            else:
+                source_body.append(elem)
+
+
+def write_icml(tree, fn):
+    """
+    Write the ICML ElementTree to fn incrementally: the elements in the Document are
+    serialized one at a time and released as they are written.
+    """
+    root = tree.getroot()
+    with open(fn, "wb") as f:
+        f.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        for pi in reversed(list(root.itersiblings(preceding=True))):
+            f.write(etree.tostring(pi, encoding="UTF-8") + b"\n")
+        with etree.xmlfile(f, encoding="UTF-8") as xf:
+            with xf.element(root.tag, root.attrib):
+                xf.write(root.text or "")
+                for ch in root.getchildren():
+                    xf.write(ch)
+                    root.remove(ch)
+        f.write(b"\n")
+
+
+class Ids:
+    """
+    A deterministic sequence of ids: the nth id is derived from the seed and n, so the
+    same seed always produces the same ids, and the ids in a sequence are unique.
+    """
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.count = 0
+        self.issued = set()
+
+    def __call__(self, length=16):
+        id = None
+        while id is None or id in self.issued:
+            self.count += 1
+            key = "%s:%d" % (self.seed, self.count)
+            n = int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16)
+            id = alpha_chars[n % len(alpha_chars)]
+            n //= len(alpha_chars)
+            while len(id) < length:
+                id += alphanum_chars[n % len(alphanum_chars)]
+                n //= len(alphanum_chars)
+        self.issued.add(id)
+        return id
+
+
+def make_id(length=16, ids=None, **params):
+    """a Self id: the next one from params['ids'], if given, otherwise random"""
+    if ids is not None:
+        return ids(length)
+    else:
+        return random_id(length)
+
 
 def make_stylename(classname):
     """convert an XML class name to an InDesign style name"""
@@ -75,15 +268,11 @@ def document(elem, **params):
     story = root.find("Story")
 
     # RootCharacterStyleGroup
+    # in order of first use, so that the output is the same each time
     charstyles = [
         charstyle
-        for charstyle in list(
-            set(
-                [
-                    c.get("AppliedCharacterStyle")
-                    for c in story.xpath(".//CharacterStyleRange")
-                ]
-            )
+        for charstyle in dict.fromkeys(
+            c.get("AppliedCharacterStyle") for c in story.iter("CharacterStyleRange")
         )
         if charstyle is not None and charstyle.strip() != ""
     ]
@@ -117,15 +306,11 @@ def document(elem, **params):
     root.insert(root.index(story), rcsg)
 
     # RootParagraphStyleGroup
+    # in order of first use, so that the output is the same each time
     parastyles = [
         parastyle
-        for parastyle in list(
-            set(
-                [
-                    p.get("AppliedParagraphStyle")
-                    for p in story.xpath(".//ParagraphStyleRange")
-                ]
-            )
+        for parastyle in dict.fromkeys(
+            p.get("AppliedParagraphStyle") for p in story.iter("ParagraphStyleRange")
         )
         if parastyle is not None and parastyle.strip() != ""
     ]
@@ -231,27 +416,45 @@ def document(elem, **params):
         root.append(b)
 
     # Place any remaining endnotes in a new ICML document named *_Endnotes.xml
-    if len(params["mutable"]["Endnotes"]) > 0:
-        endnotes_doc = XML(
-            root=document(
-                B.pub(
-                    "document",
-                    B.html("body", B.html("section", *params["mutable"]["Endnotes"])),
-                )
-            )[0],
-            fn=os.path.splitext(params.get("fn"))[0] + "_Endnotes.xml",
+    # (unless they are carried to the next document, to be placed there)
+    if (
+        len(params["mutable"]["Endnotes"]) > 0
+        and params.get("carry_endnotes") is not True
+    ):
+        write_endnotes(
+            params["mutable"]["Endnotes"],
+            os.path.splitext(params.get("fn"))[0] + "_Endnotes.xml",
+            ids=params.get("ids"),
         )
-        endnotes_doc.write()
         params["mutable"]["Endnotes"] = []
 
     return [doc]
 
 
+def write_endnotes(endnotes, fn, **params):
+    """write the endnotes to a new ICML document in fn"""
+    endnotes_doc = XML(
+        root=document(
+            B.pub("document", B.html("body", B.html("section", *endnotes))),
+            ids=params.get("ids"),
+        )[0],
+        fn=fn,
+    )
+    endnotes_doc.write()
+
+
 def pre_process_source(elem):
-    s = etree.tounicode(elem)
-    s = s.replace("<br/>", "\u2028")  # line-break codes to soft-return characters
-    e = etree.fromstring(s)
-    e = transformer_XSLT(e).getroot()
+    # line-break codes to soft-return characters, in the tree (elem is a copy)
+    for br in list(elem.iter("{%(html)s}br" % NS)):
+        if br.prefix is None and len(br.attrib) == 0 and len(br) == 0 and not br.text:
+            text = "\u2028" + (br.tail or "")
+            prev, parent = br.getprevious(), br.getparent()
+            if prev is not None:
+                prev.tail = (prev.tail or "") + text
+            else:
+                parent.text = (parent.text or "") + text
+            parent.remove(br)
+    e = transformer_XSLT(elem).getroot()
     return e
 
 
@@ -271,9 +474,8 @@ def condition_definition(name, color):
 
 @transformer.match("elem.tag=='{%(html)s}body'" % NS)
 def body(elem, **params):
-    params["story_id"] = "s" + random_id(
-        6
-    )  # to use in building unique sequential ids, such as Hyperlinks
+    # to use in building unique sequential ids, such as Hyperlinks
+    params["story_id"] = "s" + make_id(6, **params)
     story = E.Story(
         {"Self": params["story_id"]}, "\n", transformer(list(elem), **params)
     )
@@ -432,7 +634,7 @@ def para(elem, **params):
                     destname = "_" + destname
                 dest = HyperlinkTextDestination(destname)
                 p.insert(0, CharacterStyleRange(dest, **params))
-            params["Bookmarks"].append(Bookmark(txt, destname))
+            params["Bookmarks"].append(Bookmark(txt, destname, **params))
     return [p]
 
 
@@ -440,9 +642,9 @@ def destination_name():
     pass
 
 
-def Bookmark(bkmkname, destname):
+def Bookmark(bkmkname, destname, **params):
     b = E.Bookmark(
-        Self=random_id(),
+        Self=make_id(**params),
         Name=bkmkname,
         Destination="HyperlinkTextDestination/" + destname,
     )
@@ -472,7 +674,7 @@ def table(elem, **params):
     numrows = len(trs)
     numcols = len(elem.xpath("html:tr[1]/html:td", namespaces=NS))
     colwidth = 324 / numcols  # 324 points = 4.5 inches as the total width of the table
-    tblName = "t" + random_id(8)
+    tblName = "t" + make_id(8, **params)
     tbl = E.Table(
         {"Self": tblName, "BodyRowCount": str(numrows), "ColumnCount": str(numcols)},
         "\n\t\t\t",
@@ -561,7 +763,7 @@ def endnote(elem, **params):
     endnote_id = "endnote_" + elem.get("id") + "_" + params["story_id"]
     endnote_ref_id = endnote_id.replace("endnote_", "endnote_ref_")
     endnote_marker = build_endnote_marker(elem)
-    source_id = random_id(8)
+    source_id = make_id(8, **params)
     params["mutable"]["Endnotes"] += transformer(
         list(elem),
         endnote_id=endnote_id,
@@ -584,7 +786,7 @@ def endnote(elem, **params):
 
 
 def paragraph_destination(source_id, anchor, **params):
-    hyperlink_id = random_id(8)
+    hyperlink_id = make_id(8, **params)
     h = E.Hyperlink(
         {
             "Self": hyperlink_id,
@@ -709,21 +911,37 @@ def condition_elem(elem, **params):
 # == Anchors and Hyperlinks
 
 
-def HyperlinkTextDestination(name):
-    return E.HyperlinkTextDestination(
+def HyperlinkTextDestination(name, key=None):
+    dest = E.HyperlinkTextDestination(
         Self="HyperlinkTextDestination/" + name, Name=name
     )
+    if key is not None:
+        dest.set("DestinationUniqueKey", key)
+    return dest
+
+
+def chapter_anchor(name, chapter_anchors=None, **params):
+    """the chapter filename and DestinationUniqueKey of the anchor name in an export by
+    chapter (see DocumentIcml.convert_chapters), or None"""
+    return (chapter_anchors or {}).get(name)
 
 
 @transformer.match("elem.tag=='{%(pub)s}anchor_start'" % NS)
 def anchor_start(elem, **params):
     # if the anchor has a "Bookmark" attribute
     if elem.get("bkmk") is not None:
-        params["Bookmarks"].append(Bookmark(elem.get("bkmk"), elem.get("name")))
+        params["Bookmarks"].append(
+            Bookmark(elem.get("bkmk"), elem.get("name"), **params)
+        )
     return [
         "\n\t",
         CharacterStyleRange(
-            HyperlinkTextDestination(elem.get("name")), "\n\t", **params
+            HyperlinkTextDestination(
+                elem.get("name"),
+                key=(chapter_anchor(elem.get("name"), **params) or {}).get("key"),
+            ),
+            "\n\t",
+            **params
         ),
         "\n\t",
         TextContentCSR(elem.tail, **params),
@@ -735,7 +953,14 @@ def anchor_end(elem, **params):
     return [
         "\n\t",
         CharacterStyleRange(
-            HyperlinkTextDestination(elem.get("name") + "_end"), "\n\t", **params
+            HyperlinkTextDestination(
+                elem.get("name") + "_end",
+                key=(chapter_anchor(elem.get("name") + "_end", **params) or {}).get(
+                    "key"
+                ),
+            ),
+            "\n\t",
+            **params
         ),
         "\n\t",
         TextContentCSR(elem.tail, **params),
@@ -743,7 +968,16 @@ def anchor_end(elem, **params):
 
 
 def hyperlink_destination(source_id, anchor=None, url=None, **params):
-    if url is None:
+    chapter = chapter_anchor(anchor, **params) if anchor else None
+    if (
+        chapter is not None
+        and url in [None, ""]
+        and chapter.filename != os.path.basename(params.get("fn") or "")
+    ):
+        # an anchor in another chapter of the document: a cross-document destination
+        dest = "HyperlinkTextDestination/" + anchor
+        destkey = chapter.key
+    elif url is None:
         if anchor:
             dest = "HyperlinkTextDestination/" + anchor
             destkey = None
@@ -768,7 +1002,7 @@ def hyperlink_destination(source_id, anchor=None, url=None, **params):
         if anchor is not None:
             dest += "#" + anchor
 
-    hid = random_id(8)
+    hid = make_id(8, **params)
     h = E.Hyperlink(
         {
             "Self": hid,
@@ -797,7 +1031,7 @@ def HyperlinkTextSource(source_id, text, elems, **params):
 
 @transformer.match("elem.tag=='{%(pub)s}hyperlink'" % NS)
 def hyperlink_source(elem, **params):
-    source_id = random_id(8)
+    source_id = make_id(8, **params)
     params["Hyperlinks"].append(
         hyperlink_destination(
             source_id, anchor=elem.get("anchor"), url=elem.get("filename"), **params
@@ -813,7 +1047,7 @@ def hyperlink_source(elem, **params):
 
 @transformer.match("elem.tag=='{%(html)s}a' and elem.get('href') is not None" % NS)
 def hyperlink_anchor_source(elem, **params):
-    source_id = random_id(8)
+    source_id = make_id(8, **params)
     url = URL(elem.get("href"))
     params["Hyperlinks"].append(
         hyperlink_destination(
@@ -830,7 +1064,7 @@ def hyperlink_anchor_source(elem, **params):
 
 @transformer.match("elem.tag=='{%(pub)s}pageref'" % NS)
 def pageref(elem, **params):
-    crossref_id = random_id(8)
+    crossref_id = make_id(8, **params)
     params["Hyperlinks"].append(
         hyperlink_destination(crossref_id, anchor=elem.get("anchor"), **params)
     )
@@ -852,7 +1086,7 @@ def pageref(elem, **params):
 
 @transformer.match("elem.tag=='{%(pub)s}textref'" % NS)
 def textref(elem, **params):
-    crossref_id = random_id(8)
+    crossref_id = make_id(8, **params)
     params["Hyperlinks"].append(
         hyperlink_destination(crossref_id, anchor=elem.get("anchor"), **params)
     )
@@ -906,7 +1140,7 @@ def image(elem, **params):
 @transformer.match("elem.tag=='{%(pub)s}timestamp'" % NS)
 def timestamp(elem, **params):
     e = E.TextVariableInstance(
-        Self=random_id(6),
+        Self=make_id(6, **params),
         Name="Timestamp",
         ResultText=elem.text or "",
         AssociatedTextVariable="TimestampTextVariable",
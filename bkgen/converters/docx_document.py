@@ -6,7 +6,6 @@ import os
 import re
 import shutil
 import urllib.parse
-from copy import deepcopy
 
 from bl.dict import Dict
 from bl.int import Int
@@ -15,39 +14,150 @@ from bl.url import URL
 from bxml.docx import DOCX
 from bxml.xml import XML
 from bxml.xslt import XSLT
-from bxml.xt import XT
 from lxml import etree
 
 from bkgen import NS
 from bkgen.document import Document
 
-from ._converter import Converter
+from ._converter import Converter, LazyXSLT, Transformer
 
 log = logging.getLogger(__name__)
 B = Document.Builder()
-transformer = XT()
-transformer_XSLT = XSLT(fn=os.path.splitext(__file__)[0] + ".xsl")
+transformer = Transformer()
+transformer_XSLT = LazyXSLT(
+    os.path.splitext(__file__)[0] + ".xsl", compile=lambda fn: XSLT(fn=fn)
+)
 
 
 class DocxDocument(Converter):
-    def convert(self, docx, fn=None, XMLClass=Document, **params):
+    def convert(self, docx, fn=None, XMLClass=Document, stream=False, **params):
+        """
+        stream=False: If True, word/document.xml is read incrementally and transformed in
+            chunks (see document_stream), so that the Word document is never in memory as a
+            whole; the output is the same.
+        """
+        if stream is True:
+            fn = fn or docx.fn.replace(".docx", ".xml")
+            return XMLClass(root=document_stream(docx, fn=fn, **params), fn=fn)
         return docx.transform(transformer, fn=fn, XMLClass=XMLClass, **params)
 
 
 @transformer.match("elem.tag=='{%(w)s}document'" % DOCX.NS)
 def document(elem, **params):
-    # Pre-Process
-    root = deepcopy(elem)
-    root = embed_notes(root, **params)
+    # Pre-Process (elem is already a copy: the transformer doesn't modify its input)
+    root = embed_notes(elem, **params)
 
     # Transform
-    xsl_params = {
-        "source": os.path.relpath(params["docx"].fn, os.path.dirname(params["fn"]))
+    root = transformer_XSLT(root, **xsl_params(**params)).getroot()
+
+    return [post_process(root, **params)]
+
+
+def xsl_params(**params):
+    return {
+        "source": etree.XSLT.strparam(
+            os.path.relpath(params["docx"].fn, os.path.dirname(params["fn"]))
+        )
     }
-    xsl_params = {k: etree.XSLT.strparam(xsl_params[k]) for k in xsl_params.keys()}
-    root = transformer_XSLT(root, **xsl_params).getroot()
 
-    # == POST-PROCESS ==
+
+CHUNK_SIZE = 500  # body elements (paragraphs, tables) per chunk in document_stream()
+
+
+def document_stream(docx, chunk_size=CHUNK_SIZE, **params):
+    """
+    Convert the word/document.xml in docx, reading it incrementally: the body is divided
+    into chunks of chunk_size body elements, and each chunk has its notes embedded and is
+    transformed on its own, then its output is added to the output body. The output
+    document is post-processed as a whole, as in document(). Peak memory is the output
+    document plus one chunk of the Word document, rather than several copies of the Word
+    document. A chunk never ends inside a field, so each field is transformed in
+    one piece.
+    """
+    params.update(docx=docx)
+    root = None
+    for chunk in document_chunks(docx, chunk_size=chunk_size):
+        chunk = embed_notes(chunk, **params)
+        chunk_root = transformer_XSLT(chunk, **xsl_params(**params)).getroot()
+        if root is None:
+            root = chunk_root
+        else:
+            append_body(root, chunk_root)
+    return post_process(root, **params)
+
+
+def document_chunks(docx, chunk_size=CHUNK_SIZE):
+    """
+    Yield the body of word/document.xml in chunks, each a w:document containing a w:body
+    with up to chunk_size of the body elements (more, if a field is open at that point:
+    the XSLT looks for the field end in the same tree). A bookmark can span chunks: each
+    w:bookmarkEnd is given the w:name of its w:bookmarkStart, which may be in an earlier
+    chunk. The body elements are parsed incrementally and released when their chunk is done.
+    """
+    w_body = "{%(w)s}body" % DOCX.NS
+    w_fldChar = "{%(w)s}fldChar" % DOCX.NS
+    w_fldCharType = "{%(w)s}fldCharType" % DOCX.NS
+    w_bookmarkStart = "{%(w)s}bookmarkStart" % DOCX.NS
+    w_bookmarkEnd = "{%(w)s}bookmarkEnd" % DOCX.NS
+    w_id = "{%(w)s}id" % DOCX.NS
+    w_name = "{%(w)s}name" % DOCX.NS
+    document = body = None
+    elems, fields = [], 0  # the elements in the chunk; the depth of open fields
+    bookmarks = {}  # id => name of the open bookmarks
+    with docx.zipfile.open("word/document.xml") as f:
+        for event, elem in etree.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if document is None:
+                    document = elem
+                elif elem.tag == w_body:
+                    body = elem
+            elif elem.getparent() is body and body is not None:
+                elems.append(elem)
+                for e in elem.iter(w_fldChar, w_bookmarkStart, w_bookmarkEnd):
+                    if e.tag == w_bookmarkStart:
+                        bookmarks[e.get(w_id)] = e.get(w_name)
+                    elif e.tag == w_bookmarkEnd:
+                        if bookmarks.get(e.get(w_id)) is not None:
+                            e.set(w_name, bookmarks.pop(e.get(w_id)))
+                    elif e.get(w_fldCharType) == "begin":
+                        fields += 1
+                    elif e.get(w_fldCharType) == "end":
+                        fields -= 1
+                if len(elems) >= chunk_size and fields <= 0:
+                    yield chunk_document(document, body, elems)
+                    elems = []
+                elif len(elems) == 10 * chunk_size:
+                    log.warning(
+                        "%s: chunk of %d body elements, a field is still open"
+                        % (docx.fn, len(elems))
+                    )
+        yield chunk_document(document, body, elems)
+
+
+def chunk_document(document, body, elems):
+    """a w:document with the attributes of document and body, and the elems in its body"""
+    chunk = etree.Element(document.tag, document.attrib, nsmap=document.nsmap)
+    chunk.text = document.text
+    chunk_body = etree.SubElement(chunk, body.tag, body.attrib)
+    chunk_body.text, chunk_body.tail = body.text, body.tail
+    chunk_body.extend(elems)  # (the elems are moved out of the document being parsed)
+    return chunk
+
+
+def append_body(root, chunk_root):
+    """move the content of the body in chunk_root to the end of the body in root"""
+    body = root.find("{%(html)s}body" % NS)
+    chunk_body = chunk_root.find("{%(html)s}body" % NS)
+    # the content of each body is framed by "\n" ... "\t" (see the w:body template)
+    if len(body) > 0:
+        body[-1].tail = body[-1].tail[:-1] + chunk_body.text[1:]
+    else:
+        body.text = body.text[:-1] + chunk_body.text[1:]
+    body.extend(chunk_body)
+
+
+def post_process(root, **params):
+    """the steps that follow the XSLT transformation of the Word document"""
     # -- document metadata --
     root = get_document_metadata(root, **params)
     # -- styles --
@@ -81,7 +191,7 @@ def document(elem, **params):
     root = paragraphs_with_newlines(root)
     root = table_column_widths(root)
 
-    return [root]
+    return root
 
 
 def get_document_metadata(root, **params):
@@ -258,6 +368,21 @@ def split_level_sections(root, levels=1, **params):
     return root
 
 
+section_title_XSLT = LazyXSLT(
+    None,
+    compile=lambda fn: etree.XSLT(
+        XSLT.stylesheet(
+            XSLT.copy_all(),
+            XSLT.template_match("html:br", XSLT.text(" ")),
+            XSLT.template_match_omission("pub:footnote"),
+            XSLT.template_match_omission("pub:endnote"),
+            XSLT.template_match_omission("pub:comment"),
+            namespaces=NS,
+        )
+    ),
+)
+
+
 def make_section_title(section):
     title = ""
     xpath = """html:*[
@@ -267,19 +392,9 @@ def make_section_title(section):
     p = Document.find(section, xpath, namespaces=NS)
     if p is not None:
         # turn the first paragraph into the title, but omit comments and notes
-        xslt = etree.XSLT(
-            XSLT.stylesheet(
-                XSLT.copy_all(),
-                XSLT.template_match("html:br", XSLT.text(" ")),
-                XSLT.template_match_omission("pub:footnote"),
-                XSLT.template_match_omission("pub:endnote"),
-                XSLT.template_match_omission("pub:comment"),
-                namespaces=NS,
-            )
-        )
-        title = String(etree.tounicode(xslt(p).getroot(), method="text").strip()).resub(
-            r"\s+", " "
-        )
+        title = String(
+            etree.tounicode(section_title_XSLT(p).getroot(), method="text").strip()
+        ).resub(r"\s+", " ")
     return title
 
 
@@ -361,10 +476,11 @@ def section_note_numbering(root, **params):
 
 def number_lists(root, **params):
     """interpret OOXML paragraph numbering into ordered and unordered lists"""
-    numbered_p = XML.find(root, "//html:p[w:numPr]", namespaces=DOCX.NS)
+    # the numbered paragraphs are taken in document order: each one is moved into a list
+    # (at or before its position) when it is processed, so the order of the rest is unchanged.
     prev_num_params = Dict()
     lists = Dict()
-    while numbered_p is not None:
+    for numbered_p in root.xpath("//html:p[w:numPr]", namespaces=DOCX.NS):
         # build the num_params
         numPr = XML.find(numbered_p, "w:numPr", namespaces=DOCX.NS)
         numId = XML.find(numPr, "w:numId/@w:val", namespaces=DOCX.NS)
@@ -401,13 +517,6 @@ def number_lists(root, **params):
             li.getchildren()[-1].tail = ""
             lists[level].append(li)
             prev_num_params = num_params
-            numbered_p = XML.find(
-                lists[level], "following::html:p[w:numPr]", namespaces=DOCX.NS
-            )
-        else:
-            numbered_p = XML.find(
-                numbered_p, "following::html:p[w:numPr]", namespaces=DOCX.NS
-            )
     return root
 
 
@@ -508,22 +617,13 @@ def get_images(root, **params):
     docx = params["docx"]
     image_subdir = params.get("image_subdir") or "images"
     output_path = params.get("output_path") or os.path.dirname(params["fn"])
-    rels = docx.xml(src="word/_rels/document.xml.rels").root
+    rels = docx.relationships()
     imgs = root.xpath("//html:img", namespaces=DOCX.NS)
     for img in imgs:
-        embed_rel = XML.find(
-            rels,
-            "//rels:Relationship[@Id='%s']" % img.get("data-embed-id"),
-            namespaces=DOCX.NS,
-        )
-        link_rel = XML.find(
-            rels,
-            "//rels:Relationship[@Id='%s']" % img.get("data-link-id"),
-            namespaces=DOCX.NS,
-        )
+        embed_rel = rels.get(img.get("data-embed-id"))
+        link_rel = rels.get(img.get("data-link-id"))
         # source image
         if embed_rel is not None:
-            fd = docx.read("word/" + embed_rel.get("Target"))
             imgfn = os.path.join(
                 output_path,
                 image_subdir,
@@ -531,8 +631,10 @@ def get_images(root, **params):
             )
             if not os.path.isdir(os.path.dirname(imgfn)):
                 os.makedirs(os.path.dirname(imgfn))
-            with open(imgfn, "wb") as f:
-                f.write(fd)
+            with docx.zipfile.open("word/" + embed_rel.get("Target")) as fd, open(
+                imgfn, "wb"
+            ) as f:
+                shutil.copyfileobj(fd, f)
             img.set("src", os.path.relpath(imgfn, output_path))
         elif link_rel is not None:
             img.set("src", link_rel.get("Target"))
@@ -553,13 +655,13 @@ def get_images(root, **params):
 
 def resolve_hyperlinks(root, **params):
     docx = params["docx"]
-    rels = docx.xml(src="word/_rels/document.xml.rels").root
+    rels = docx.relationships()
     aa = root.xpath("//html:a[@data-rel-id or @data-anchor]", namespaces=DOCX.NS)
     for a in aa:
         href = ""
         if a.get("data-rel-id") is not None:
             rId = a.attrib.pop("data-rel-id")
-            rel = rels.find("{%s}Relationship[@Id='%s']" % (DOCX.NS.rels, rId))
+            rel = rels.get(rId)
             if rel is not None:
                 href += urllib.parse.unquote(rel.get("Target").replace(".docx", ".xml"))
         if "#" not in href and a.get("data-anchor") is not None:
@@ -428,7 +428,8 @@
 
     <xsl:template match="w:bookmarkEnd">
     	<xsl:param name="id" select="@w:id"/>
-        <xsl:param name="anchor" select="//w:bookmarkStart[@w:id=$id]/@w:name"/>
+        <!-- (in a streaming import, @w:name is the name of a w:bookmarkStart in an earlier chunk) -->
+        <xsl:param name="anchor" select="//w:bookmarkStart[@w:id=$id]/@w:name | @w:name"/>
         <xsl:if test="not(starts-with($anchor, '_'))">
             <span class="anchor">
                 <xsl:attribute name="id">
@@ -7,17 +7,16 @@ from bl.string import String
 from bl.url import URL
 from bxml import XML
 from bxml.builder import Builder
-from bxml.xt import XT
 from lxml import etree
 
 from bkgen import NS
 from bkgen.document import Document
 
-from ._converter import Converter
+from ._converter import Converter, LazyXSLT, Transformer
 
 B = Builder(**NS)
-transformer = XT()
-transformer_XSLT = etree.XSLT(etree.parse(os.path.splitext(__file__)[0] + ".xsl"))
+transformer = Transformer()
+transformer_XSLT = LazyXSLT(os.path.splitext(__file__)[0] + ".xsl")
 
 
 class HtmlDocument(Converter):
@@ -4,6 +4,7 @@ import logging
 import os
 import re
 import tempfile
+import time
 import urllib.parse
 
 from bl.dict import Dict
@@ -14,22 +15,21 @@ from bl.string import String
 from bl.url import URL
 from bxml.builder import Builder
 from bxml.xml import XML
-from bxml.xt import XT
 from lxml import etree
 
 import bkgen
+from bkgen.destinations import Destinations
 from bkgen.document import Document
 from bkgen.icml import ICML
 
-from ._converter import Converter
+from ._converter import Converter, Transformer
 
 log = logging.getLogger(__name__)
 
 
-NS = bkgen.NS
-NS.update(**{k: bkgen.NS[k] for k in bkgen.NS if "aid" in k})
+NS = bkgen.NS  # shared; it already has the aid namespaces, and it must not be modified
 B = Builder(default=NS.html, **NS)
-transformer = XT()
+transformer = Transformer()
 
 
 class IcmlDocument(Converter):
@@ -42,12 +42,15 @@ class IcmlDocument(Converter):
 def TheDocument(elem, **params):
     if params.get("document_path") is None:
         params["document_path"] = os.path.dirname(params.get("fn"))
-    if params.get("fns") is not None:
-        # load all the documents in params['fns']
-        params["documents"] = [XML(fn=fn) for fn in params["fns"]]
+    if params.get("destinations") is None and params.get("fns") is not None:
+        # index the destinations in all the documents in params['fns']
+        params["destinations"] = Destinations(fns=params["fns"])
     params["footnotes"] = []
 
     elem = pre_process(elem, **params)
+    params["story_destinations"] = Destinations.index_elements(
+        elem.getroottree().getroot(), Destinations.filename(params["fn"])
+    )
     root = B.pub.document(
         "\n\t", B.html.body("\n", transformer(elem.getchildren(), **params))
     )
@@ -296,10 +299,13 @@ def HyperlinkTextDestination(elem, **params):
     attrib = {"id": make_element_id(elem, **params)}
 
     # If the anchor defines a bookmark, create a section_start
-    bookmark_xpath = (
-        "//Bookmark[@Destination='HyperlinkTextDestination/%s']" % elem.get("Name")
+    bookmark = find_in_documents_or_sources(
+        elem,
+        "Destination",
+        "HyperlinkTextDestination/%s" % elem.get("Name"),
+        tag="Bookmark",
+        **params,
     )
-    bookmark = find_in_documents_or_sources(elem, bookmark_xpath, **params)
     if bookmark is not None:
         attrib.update(title=bookmark_title(bookmark["element"]))
         section_start = B.pub.section_start(
@@ -336,8 +342,9 @@ def HyperlinkTextOrCrossReferenceSource(elem, **params):
             cc[0].set(k, hyperlink.get(k))
         result = cc
     else:
-        find_xpath = "//Hyperlink[@Source='%(Self)s']" % elem.attrib
-        found_hyperlink = find_in_documents_or_sources(elem, find_xpath, **params)
+        found_hyperlink = find_in_documents_or_sources(
+            elem, "Source", elem.get("Self"), tag="Hyperlink", **params
+        )
         if found_hyperlink is None:
             log.warn("No hyperlink found for %s=%r" % (XML.tag_name(elem), elem))
         else:
@@ -352,11 +359,13 @@ def HyperlinkTextOrCrossReferenceSource(elem, **params):
 def hyperlink_href(hyperlink_elem, source=None, **params):
     attribs = {}
     if hyperlink_elem.get("DestinationUniqueKey") is not None:
-        find_xpath = (
-            "//*[contains(name(), 'Destination') and @DestinationUniqueKey='%s']"
-            % hyperlink_elem.get("DestinationUniqueKey")
+        found = find_in_documents_or_sources(
+            hyperlink_elem,
+            "DestinationUniqueKey",
+            hyperlink_elem.get("DestinationUniqueKey"),
+            tag=lambda tag: "Destination" in tag,
+            **params,
         )
-        found = find_in_documents_or_sources(hyperlink_elem, find_xpath, **params)
         if found is not None:
             attribs["idref"] = make_element_id(found["element"], fn=found["filename"])
             attribs["filename"] = found["filename"]
@@ -365,16 +374,26 @@ def hyperlink_href(hyperlink_elem, source=None, **params):
     destination = hyperlink_elem.find("Properties/Destination")
     if destination is not None:
         if "HyperlinkTextDestination/" in destination.text:
-            find_xpath = "//HyperlinkTextDestination[@Self='%s']" % destination.text
-            found = find_in_documents_or_sources(hyperlink_elem, find_xpath, **params)
+            found = find_in_documents_or_sources(
+                hyperlink_elem,
+                "Self",
+                destination.text,
+                tag="HyperlinkTextDestination",
+                **params,
+            )
             if found is not None:
                 attribs["idref"] = make_element_id(
                     found["element"], fn=found["filename"]
                 )
                 attribs["filename"] = found["filename"]
         elif "HyperlinkURLDestination/" in destination.text:
-            find_xpath = "//HyperlinkURLDestination[@Self='%s']" % destination.text
-            found = find_in_documents_or_sources(hyperlink_elem, find_xpath, **params)
+            found = find_in_documents_or_sources(
+                hyperlink_elem,
+                "Self",
+                destination.text,
+                tag="HyperlinkURLDestination",
+                **params,
+            )
             if found is not None:
                 attribs["idref"] = make_element_id(
                     found["element"], fn=found["filename"]
@@ -400,28 +419,23 @@ def hyperlink_href(hyperlink_elem, source=None, **params):
     }
 
 
-def find_in_documents_or_sources(elem, xpath, **params):
-    """find the given xpath target in the current document or the accompanying documents and sources
-    params['documents'] = ICML file objects
-    params['sources'] = IDML file objects
+def find_in_documents_or_sources(
+    elem, attr, value, tag=None, story_destinations=None, destinations=None, **params
+):
+    """find the element with the given attribute value (and tag) in the document that
+    contains elem, the current story, or the other documents and sources in the book.
+    params['story_destinations'] = the index of the current story
+    params['destinations'] = the Destinations index of the book
     """
-    target_elem = XML.find(elem, xpath, namespaces=Document.NS)
-    if target_elem is not None:
-        result = {
-            "element": target_elem,
-            "filename": os.path.splitext(os.path.basename(params["fn"]))[0] + ".xml",
-        }
-        return result
-    for doc in (params.get("documents") or []) + (params.get("sources") or []):
-        target_elem = (doc.root and XML.find(doc.root, xpath)) or (
-            doc.designmap and XML.find(doc.designmap.root, xpath)
+    found = Destinations.lookup(story_destinations, attr, value, tag=tag)
+    if destinations is not None:
+        found += destinations.find(attr, value, tag=tag)
+    if len(found) > 0:
+        root = elem.getroottree().getroot()
+        target_elem, filename = next(
+            (f for f in found if f[0].getroottree().getroot() is root), found[0]
         )
-        if target_elem is not None:
-            result = {
-                "element": target_elem,
-                "filename": os.path.splitext(os.path.basename(doc.fn))[0] + ".xml",
-            }
-            return result
+        return {"element": target_elem, "filename": filename}
 
 
 def make_element_id(elem, fn=None, **params):
@@ -458,7 +472,11 @@ def bookmark_title(bookmark):
 @transformer.match("elem.tag=='TextVariableInstance'")
 def TextVariableInstance(elem, **params):
     found = find_in_documents_or_sources(
-        elem, "//TextVariable[@Self='%s']" % elem.get("AssociatedTextVariable")
+        elem,
+        "Self",
+        elem.get("AssociatedTextVariable"),
+        tag="TextVariable",
+        **params,
     )
     if found is not None:
         text_variable = found["element"]
@@ -717,37 +735,41 @@ def pre_process(root, **params):
     return root
 
 
-def post_process(root, **params):
-    root = convert_line_page_breaks(root)
-    root = remove_empty_spans(root)
-    root = process_t_codes(root)
-    root = process_endnotes(root)
-    root = hyperlinks_inside_paras(root)
-    root = unpack_nested_paras(root)
-    root = anchors_shift_paras(root)
-    root = anchors_outside_hyperlinks(root)
-    root = anchors_inside_paras(root)
-    root = fix_endnote_refs(root)
+def post_process(root, timings=None, **params):
+    """
+    Run the post-processing steps on the document root, in order. Each step is timed:
+    timings = a dict in which the seconds spent in each step are accumulated (by name).
+    """
+    steps = [
+        convert_line_page_breaks,
+        remove_empty_spans_and_t_codes,
+        process_endnotes,
+        hyperlinks_inside_paras,
+        unpack_nested_paras,
+        anchors_shift_paras,
+        anchors_outside_hyperlinks,
+        anchors_inside_paras,
+        fix_endnote_refs,
+    ]
     if params.get("preserve_paragraphs") is not True:
-        root = remove_empty_paras(root)
+        steps.append(remove_empty_paras)
     if params.get("convert_lists") is True:
-        root = convert_lists(root)
+        steps.append(convert_lists)
     else:
-        for p in Document.xpath(root, "//html:p[@BulletsAndNumberingListType]"):
-            p.attrib.pop("BulletsAndNumberingListType")
-    root = remove_container_sections(root)
-    root = unnest_p_divs(root)
-    root = unnest_tables_from_p(root)
-    for section in root.xpath("//html:section", namespaces=NS):
-        chs = section.getchildren()
-        if len(chs) == 1 and chs[0].tag == "{%(pub)s}include" % bkgen.NS:
-            Document.replace_with_contents(section)
-        else:
-            section.tail = "\n"
-    for incl in root.xpath("//html:p/pub:include", namespaces=NS):
-        XML.unnest(incl)
-    root = remove_empty_p(root)
-    root = p_tails(root)
+        steps.append(remove_list_types)
+    steps += [
+        remove_container_sections,
+        unnest_p_divs,
+        unnest_tables_from_p,
+        unpack_section_includes,
+        remove_empty_p_and_p_tails,
+    ]
+    for step in steps:
+        start = time.perf_counter()
+        root = step(root)
+        if timings is not None:
+            elapsed = time.perf_counter() - start
+            timings[step.__name__] = timings.get(step.__name__, 0) + elapsed
     return root
 
 
@@ -795,6 +817,18 @@ def process_t_codes(root):
     return root
 
 
+def remove_empty_spans_and_t_codes(root):
+    """remove_empty_spans() and process_t_codes() in one pass over the document"""
+    for elem in list(root.iter("{%(html)s}span" % NS, "{%(pub)s}t" % NS)):
+        if (
+            elem.tag == "{%(pub)s}t" % NS
+            or elem.attrib.keys() == []
+            or XML.is_empty(elem, ignore_whitespace=True)
+        ):
+            XML.replace_with_contents(elem)
+    return root
+
+
 def convert_line_page_breaks(root):
     txt = etree.tounicode(root)
     txt = txt.replace("\u2028", "<br/>")  # forced line break
@@ -885,6 +919,25 @@ def convert_lists(root):
     return root
 
 
+def remove_list_types(root):
+    for p in Document.xpath(root, "//html:p[@BulletsAndNumberingListType]"):
+        p.attrib.pop("BulletsAndNumberingListType")
+    return root
+
+
+def unpack_section_includes(root):
+    """sections that only contain an include are unpacked; includes are unnested from paras"""
+    for section in root.xpath("//html:section", namespaces=NS):
+        chs = section.getchildren()
+        if len(chs) == 1 and chs[0].tag == "{%(pub)s}include" % bkgen.NS:
+            Document.replace_with_contents(section)
+        else:
+            section.tail = "\n"
+    for incl in root.xpath("//html:p/pub:include", namespaces=NS):
+        XML.unnest(incl)
+    return root
+
+
 def p_tails(root):
     for p in root.xpath(
         ".//html:p | .//html:table | .//html:div | .//html:section", namespaces=NS
@@ -911,18 +964,17 @@ def anchors_shift_paras(root):
                 a = a.getnext()
             if a is None or a.tag != "{%(pub)s}anchor_end" % NS:
                 break
-            prevs = p.xpath("preceding::html:p", namespaces=NS)
-            if len(prevs) > 0:
-                prev = prevs[-1]
+            prev = preceding_p(p)
+            if prev is not None:
                 while (
                     prev is not None
                     and len(prev.getchildren()) == 0
                     and prev.text in [None, ""]
                 ):
-                    prevs = prev.xpath("preceding::html:p", namespaces=NS)
-                    if len(prevs) == 0:
+                    earlier = preceding_p(prev)
+                    if earlier is None:
                         break
-                    prev = prevs[-1]
+                    prev = earlier
                 if prev is not None:
                     XML.remove(a, leave_tail=True)
                     a.tail = ""
@@ -935,17 +987,37 @@ def anchors_shift_paras(root):
             and p.getchildren()[-1].tail in [None, ""]
         ):
             a = p.getchildren()[-1]
-            nexts = p.xpath("following::html:p", namespaces=NS)
-            if len(nexts) > 0:
+            next_p = following_p(p)
+            if next_p is not None:
                 XML.remove(a, leave_tail=True)
-                nexts[0].insert(0, a)
-                if nexts[0].text not in [None, ""]:
-                    nexts[0].text, a.tail = "", nexts[0].text
+                next_p.insert(0, a)
+                if next_p.text not in [None, ""]:
+                    next_p.text, a.tail = "", next_p.text
             else:
                 break
     return root
 
 
+def following_p(elem):
+    """the first html:p after elem (and its descendants) in the document, or None"""
+    while elem is not None:
+        for sibling in elem.itersiblings():
+            p = next(sibling.iter("{%(html)s}p" % NS), None)
+            if p is not None:
+                return p
+        elem = elem.getparent()
+
+
+def preceding_p(elem):
+    """the last html:p before elem (and its ancestors) in the document, or None"""
+    while elem is not None:
+        for sibling in elem.itersiblings(preceding=True):
+            ps = list(sibling.iter("{%(html)s}p" % NS))
+            if len(ps) > 0:
+                return ps[-1]
+        elem = elem.getparent()
+
+
 def anchors_outside_hyperlinks(root):
     "make sure anchors are outside of hyperlinks"
     for a in root.xpath("//pub:anchor[ancestor::pub:hyperlink]", namespaces=NS):
@@ -966,18 +1038,16 @@ def anchors_outside_hyperlinks(root):
 def anchors_inside_paras(root):
     """anchor at the start of the next para, anchor_end at the end of the previous para"""
     for anchor in root.xpath("//pub:anchor[not(ancestor::html:p)]", namespaces=NS):
-        paras = anchor.xpath("following::html:p", namespaces=NS)
-        if len(paras) > 0:
-            para = paras[0]
+        para = following_p(anchor)
+        if para is not None:
             XML.remove(anchor, leave_tail=True)
             para.insert(0, anchor)
             anchor.tail, para.text = para.text, ""
     for anchor_end in root.xpath(
         "//pub:anchor_end[not(ancestor::html:p)]", namespaces=NS
     ):
-        paras = anchor_end.xpath("preceding::html:p", namespaces=NS)
-        if len(paras) > 0:
-            para = paras[-1]
+        para = preceding_p(anchor_end)
+        if para is not None:
             XML.remove(anchor_end, leave_tail=True)
             para.append(anchor_end)
     return root
@@ -1082,6 +1152,39 @@ def unnest_tables_from_p(root):
     return root
 
 
+P_TAGS = [
+    "{%s}%s" % (NS.html, tag) for tag in ["p"] + ["h%d" % i for i in range(1, 10)]
+]
+BLOCK_TAGS = ["{%s}%s" % (NS.html, tag) for tag in ["p", "table", "div", "section"]]
+
+
+def remove_empty_p_and_p_tails(root):
+    """
+    remove_empty_p() and p_tails() in one traversal of the document: the empty paras are
+    removed, then the block elements get newline tails.
+    """
+    empty, blocks = [], []
+    stack = [(elem, False) for elem in reversed(root.getchildren())]
+    while len(stack) > 0:
+        elem, in_table = stack.pop()
+        if (
+            elem.tag in P_TAGS
+            and not in_table
+            and (elem.text is None or elem.text.strip() == "")
+            and len(elem) == 0
+        ):
+            empty.append(elem)
+        if elem.tag in BLOCK_TAGS:
+            blocks.append(elem)
+        in_table = in_table or elem.tag == "{%(html)s}table" % NS
+        stack += [(ch, in_table) for ch in reversed(elem.getchildren())]
+    for p in empty:
+        XML.remove(p, leave_tail=True)
+    for elem in blocks:
+        elem.tail = "\n"
+    return root
+
+
 def remove_empty_p(root):
     for p in root.xpath(
         """
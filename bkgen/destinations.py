@@ -0,0 +1,101 @@
+"""
+An index of the hyperlink destinations, bookmarks, hyperlinks, text variables and other
+named objects in a collection of InDesign sources (an InDesign book). Each source is opened
+once, and the index is built once, so that all the story conversions in an import resolve
+their hyperlinks and cross-references by lookup rather than by searching every source.
+"""
+
+import logging
+import os
+import threading
+
+from bxml import XML
+from lxml import etree
+
+log = logging.getLogger(__name__)
+
+
+class Destinations:
+    ATTRIBUTES = ["Self", "Name", "DestinationUniqueKey", "Destination", "Source"]
+
+    def __init__(self, fns=None, sources=None):
+        """
+        fns = the filenames of the sources in the book, in order.
+        sources = {fn: source} for the sources that are already open.
+        """
+        self.fns = [os.path.abspath(fn) for fn in fns or []]
+        self.sources = {os.path.abspath(fn): src for fn, src in (sources or {}).items()}
+        self.lock = threading.RLock()
+        self.__index = None
+
+    def source(self, fn, source=None):
+        """the source object for fn, opened once; source = the object to use if not open"""
+        from .icml import ICML
+        from .idml import IDML
+
+        fn = os.path.abspath(fn)
+        with self.lock:
+            if fn not in self.sources:
+                if source is not None:
+                    self.sources[fn] = source
+                elif os.path.splitext(fn)[-1].lower() == ".idml":
+                    self.sources[fn] = IDML(fn=fn)
+                elif os.path.splitext(fn)[-1].lower() == ".icml":
+                    self.sources[fn] = ICML(fn=fn)
+                else:
+                    self.sources[fn] = XML(fn=fn)
+            return self.sources[fn]
+
+    @classmethod
+    def filename(C, fn):
+        """the filename of the document that is output from the source fn"""
+        return os.path.splitext(os.path.basename(fn))[0] + ".xml"
+
+    @classmethod
+    def roots(C, source):
+        """the root elements of the source that are searched for destinations: for an IDML
+        source, only the designmap (a story's own destinations are found in the story index
+        of its conversion)"""
+        if source.designmap is not None:  # IDML
+            return [source.designmap.root]
+        else:
+            return [source.root]
+
+    @classmethod
+    def index_elements(C, root, filename, index=None):
+        """add the elements in root to the index: (attribute, value) => [(elem, filename)]"""
+        if index is None:
+            index = {}
+        for elem in root.iter(etree.Element):
+            for attr in C.ATTRIBUTES:
+                value = elem.get(attr)
+                if value is not None:
+                    index.setdefault((attr, value), []).append((elem, filename))
+        return index
+
+    @property
+    def index(self):
+        with self.lock:
+            if self.__index is None:
+                index = {}
+                for fn in self.fns:
+                    for root in self.roots(self.source(fn)):
+                        self.index_elements(root, self.filename(fn), index=index)
+                log.debug("%d sources, %d keys indexed", len(self.fns), len(index))
+                self.__index = index
+            return self.__index
+
+    @classmethod
+    def lookup(C, index, attr, value, tag=None):
+        """
+        [(elem, filename), ...] in index with the given attribute value, in document
+        order. tag = the element tag, or a function of the tag, to filter by.
+        """
+        return [
+            (elem, filename)
+            for elem, filename in (index or {}).get((attr, value), [])
+            if tag is None or (tag(elem.tag) if callable(tag) else elem.tag == tag)
+        ]
+
+    def find(self, attr, value, tag=None):
+        return self.lookup(self.index, attr, value, tag=tag)
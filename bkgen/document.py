@@ -109,6 +109,13 @@ class Document(XML, Source):
         converter = DocumentIcml()
         return converter.convert(self, **params)
 
+    def icml_chapters(self, path=None, **params):
+        """write one .icml file per chapter of the document to path; return the filenames"""
+        from .converters.document_icml import DocumentIcml
+
+        converter = DocumentIcml()
+        return converter.convert_chapters(self, path=path, **params)
+
     def aid(self, fn=None, **params):
         from .converters.document_aid import DocumentAid
 
@@ -118,7 +125,7 @@ class Document(XML, Source):
         return converter.convert(self, fn=fn, **params)
 
     def html(
-        self, fn=None, ext=".xhtml", output_path=None, resources=[], lang="en", **args
+        self, fn=None, ext=".xhtml", output_path=None, resources=None, lang="en", **args
     ):
         from .converters.document_html import DocumentHtml
 
@@ -126,11 +133,16 @@ class Document(XML, Source):
         fn = fn or os.path.splitext(self.fn)[0] + ext
         output_path = output_path or self.path
         h = converter.convert(
-            self, fn=fn, output_path=output_path, resources=resources, lang=lang, **args
+            self,
+            fn=fn,
+            output_path=output_path,
+            resources=resources or [],
+            lang=lang,
+            **args,
         )
         return h
 
-    def html_content(self, fn=None, output_path=None, resources=[], **args):
+    def html_content(self, fn=None, output_path=None, resources=None, **args):
         h = self.html(fn=fn, output_path=output_path, resources=resources, **args)
         return "\n".join(
             [
@@ -139,38 +151,14 @@ class Document(XML, Source):
             ]
         )
 
-    def render_includes(self, strip=False):
-        """put included content into the <pub:include> elements in the document."""
-        for incl in self.root.xpath("//pub:include", namespaces=NS):
-            # remove existing content from the include
-            incl.text = "\n"
-            for ch in incl.getchildren():
-                incl.remove(ch)
-
-            # fill the include with the included content from the source
-            srcfn = os.path.abspath(
-                os.path.join(
-                    os.path.dirname(self.fn), str(URL(incl.get("src"))).split("#")[0]
-                )
-            )
-            if os.path.exists(srcfn):
-                src = Document(fn=srcfn)
-                if "#" in incl.get("src"):
-                    srcid = str(URL(incl.get("src"))).split("#")[-1]
-                    incl_elems = XML.xpath(src.root, "//*[@id='%s']" % srcid)
-                else:
-                    incl_elems = XML.xpath(src.root, "html:body/*", namespaces=NS)
-
-                if len(incl_elems) == 0:
-                    log.warn("NO ELEMENTS TO INCLUDE: %s", incl.get("src"))
-
-                for ie in incl_elems:
-                    incl.append(ie)
-            else:
-                log.error("INCLUDE SRC FILE NOT FOUND: %s", incl.get("src"))
-
-            if strip is True:
-                self.replace_with_contents(incl)
+    def render_includes(self, strip=False, includes=None):
+        """put included content into the <pub:include> elements in the document.
+        includes = the Includes resolver to use, so that the documents in a build can share
+        the parsed sources and the include dependency graph.
+        """
+        from .includes import Includes
+
+        (includes or Includes()).render(self.root, self.fn, strip=strip)
 
     def section_content(self, section_id):
         """return an xml string containing the content of the section"""
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 
 import bxml.docx
@@ -22,6 +23,42 @@ class DOCX(bxml.docx.DOCX, Source):
         doc = converter.convert(self, fn=fn, **params)
         return doc
 
+    def stylemap(self, definitions=True, all=True, cache=False):
+        """return a dictionary of the styles in word/styles.xml, keyed to the style id.
+        Unlike bxml's DOCX.stylemap, only word/styles.xml is read (unless all=False, which
+        needs the document to find the styles that are used), so that the streaming import
+        never loads word/document.xml.
+        """
+        if all is not True:
+            return super().stylemap(definitions=definitions, all=all, cache=cache)
+        if self._stylemap is not None and cache == True:
+            return self._stylemap
+        self._stylemap = None  # expire the cache
+        x = self.xml(src="word/styles.xml")
+        d = Dict()
+        for s in x.root.xpath("w:style", namespaces=self.NS):
+            style = Dict()
+            style.id = s.get("{%(w)s}styleId" % self.NS)
+            style.type = s.get("{%(w)s}type" % self.NS)
+            style.xpath = (
+                "//w:rStyle[@w:val='%(id)s'] | //w:pStyle[@w:val='%(id)s']" % style
+            )
+            style.name = XML.find(s, "w:name/@w:val", namespaces=self.NS)
+            d[style.id] = style
+            if definitions is True:
+                bo = s.find("{%(w)s}basedOn" % self.NS)
+                if bo is not None:
+                    style.basedOn = bo.get("{%(w)s}val" % self.NS)
+                style.properties = Dict()
+                for pr in s.xpath("w:pPr/* | w:rPr/*", namespaces=self.NS):
+                    props = Dict()
+                    for attr in pr.attrib.keys():
+                        props[re.sub(r"^\{[^}]*\}", "", attr)] = pr.get(attr)
+                    style.properties[re.sub(r"^\{[^}]*\}", "", pr.tag)] = props
+        if cache is True:
+            self._stylemap = d
+        return d
+
     # == Source Properties ==
 
     def documents(self, path=None, **params):
@@ -39,19 +76,11 @@ class DOCX(bxml.docx.DOCX, Source):
         from bf.image import Image
 
         images = []
-        rels = self.xml(src="word/_rels/document.xml.rels").root
+        rels = self.relationships()
         for img in self.xml().root.xpath("//html:img", namespaces=DOCX.NS):
             image = Image()
-            link_rel = XML.find(
-                rels,
-                "//rels:Relationship[@Id='%s']" % img.get("data-link-id"),
-                namespaces=DOCX.NS,
-            )
-            embed_rel = XML.find(
-                rels,
-                "//rels:Relationship[@Id='%s']" % img.get("data-embed-id"),
-                namespaces=DOCX.NS,
-            )
+            link_rel = rels.get(img.get("data-link-id"))
+            embed_rel = rels.get(img.get("data-embed-id"))
             if link_rel is not None:
                 image.fn = URL(link_rel.get("Target")).path
                 if embed_rel is not None:
@@ -62,6 +91,19 @@ class DOCX(bxml.docx.DOCX, Source):
             images.append(image)
         return images
 
+    def relationships(self, src="word/_rels/document.xml.rels"):
+        """{Id: Relationship element} for the relationships part src, indexed once"""
+        if self.__relationships is None:
+            self.__relationships = {}
+        if src not in self.__relationships:
+            index = self.__relationships[src] = {}
+            rels = self.xml(src=src)
+            if rels is not None:
+                for rel in rels.root.iterfind("{%s}Relationship" % DOCX.NS.rels):
+                    if rel.get("Id") is not None:
+                        index.setdefault(rel.get("Id"), rel)
+        return self.__relationships[src]
+
     def metadata(self):
         """return a Metadata object with the metadata in the document"""
         from .metadata import Metadata
@@ -75,39 +117,53 @@ class DOCX(bxml.docx.DOCX, Source):
     def stylesheet(self):
         return super().stylesheet()
 
+    def numbering(self):
+        """
+        Indexes of word/numbering.xml, built once: Dict(nums={numId: abstractNumId},
+        levels={(abstractNumId, ilvl): w:lvl element}).
+        """
+        if self.__numbering is None:
+            numbering = Dict(nums={}, levels={})
+            x = self.xml(src="word/numbering.xml")
+            if x is not None:
+                # (the first definition of each id is the one that is used)
+                for num in x.root.iterfind("w:num", namespaces=self.NS):
+                    numbering.nums.setdefault(
+                        num.get("{%(w)s}numId" % self.NS),
+                        XML.find(num, "w:abstractNumId/@w:val", namespaces=self.NS),
+                    )
+                abstractNumIds = set()
+                for abstractNum in x.root.iterfind("w:abstractNum", namespaces=self.NS):
+                    abstractNumId = abstractNum.get("{%(w)s}abstractNumId" % self.NS)
+                    if abstractNumId in abstractNumIds:
+                        continue
+                    abstractNumIds.add(abstractNumId)
+                    for lvl in abstractNum.iterfind("w:lvl", namespaces=self.NS):
+                        key = (abstractNumId, lvl.get("{%(w)s}ilvl" % self.NS))
+                        numbering.levels.setdefault(key, lvl)
+            self.__numbering = numbering
+        return self.__numbering
+
     def numbering_params(self, numId, level):
         """return numbering parameters for the given w:numId an w:lvl / w:ilvl"""
-        numbering = self.xml(src="word/numbering.xml")
+        numbering = self.numbering()
         params = Dict(level=str(level))
-        num = XML.find(
-            numbering.root, "//w:num[@w:numId='%s']" % numId, namespaces=self.NS
-        )
-        if num is not None:
+        if numId in numbering.nums:
             params.update(id=numId)
-            abstractNumId = XML.find(num, "w:abstractNumId/@w:val", namespaces=self.NS)
+            abstractNumId = numbering.nums[numId]
             if abstractNumId is not None:
-                abstractNum = XML.find(
-                    numbering.root,
-                    "//w:abstractNum[@w:abstractNumId='%s']" % abstractNumId,
-                    namespaces=self.NS,
-                )
-                if abstractNum is not None:
-                    lvl = XML.find(
-                        abstractNum,
-                        "w:lvl[@w:ilvl='%s']" % params.level,
-                        namespaces=self.NS,
+                lvl = numbering.levels.get((abstractNumId, params.level))
+                if lvl is not None:
+                    params["start"] = XML.find(
+                        lvl, "w:start/@w:val", namespaces=self.NS
+                    )
+                    params["numFmt"] = XML.find(
+                        lvl, "w:numFmt/@w:val", namespaces=self.NS
                     )
-                    if lvl is not None:
-                        params["start"] = XML.find(
-                            lvl, "w:start/@w:val", namespaces=self.NS
-                        )
-                        params["numFmt"] = XML.find(
-                            lvl, "w:numFmt/@w:val", namespaces=self.NS
-                        )
-                        if params["numFmt"] == "bullet":
-                            params["ul"] = True
-                        else:
-                            params["ol"] = True
+                    if params["numFmt"] == "bullet":
+                        params["ul"] = True
+                    else:
+                        params["ol"] = True
         return params
 
 
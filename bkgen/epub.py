@@ -1,10 +1,15 @@
 import logging
 import mimetypes
 import os
+import posixpath
+import shutil
 import subprocess
+import tempfile
+import time
 import zipfile
 from copy import deepcopy
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from uuid import uuid4
 
 from bl.dict import Dict
@@ -19,7 +24,6 @@ from bxml.xml import XML
 from lxml import etree
 
 from bkgen import NS, config
-from bkgen.css import CSS
 from bkgen.html import HTML
 from bkgen.source import Source
 
@@ -52,6 +56,9 @@ class EPUB(ZIP, Source):
             ".xhtml": "application/xhtml+xml",
         }
     )
+    BUFFER_SIZE = 1024 * 1024  # bounded buffer for streaming zip members to disk
+    # elements whose @href is an intra-book reference to be checked by preflight()
+    PREFLIGHT_HREF_TAGS = ["{%s}%s" % (NS.html, tag) for tag in ["a", "area", "link"]]
 
     def check(self, xml=False):
         """use epubcheck to validate the epub"""
@@ -67,6 +74,198 @@ class EPUB(ZIP, Source):
         log.info("epubcheck log: %s" % checkfn)
         return checkfn
 
+    @classmethod
+    def preflight(C, fn, reportfn=None):
+        """
+        Fast in-process structural check of a built .epub file or _EPUB folder, so that
+        builds can fail fast without the Java dependency of epubcheck. Checks:
+
+        * mimetype is the first zip entry, stored (uncompressed), with the EPUB mediatype
+        * META-INF/container.xml points to an OPF that exists
+        * every manifest item exists, and every file is listed in the manifest
+        * every spine itemref refers to a manifest item
+        * intra-book links and their fragment ids resolve (as in HTML.audit_links)
+        * no duplicate ids within a content document; no missing images
+
+        Content documents are read with streaming parsing (iterparse). Returns a Dict
+        with the lists of `errors` and `warnings`; if reportfn is given, also write the
+        messages to that file.
+        """
+        start_time = time.time()
+        result = Dict(fn=fn, errors=[], warnings=[])
+
+        # -- package members --
+        if os.path.isdir(fn):
+            names = set()
+            for dirpath, _, filenames in os.walk(fn):
+                for filename in filenames:
+                    names.add(
+                        os.path.relpath(os.path.join(dirpath, filename), fn).replace(
+                            "\\", "/"
+                        )
+                    )
+            zf = None
+            if "mimetype" not in names:
+                result.errors.append("mimetype: file not found")
+            else:
+                with open(os.path.join(fn, "mimetype"), "rb") as f:
+                    if f.read().strip() != C.MEDIATYPES[".epub"].encode("ascii"):
+                        result.errors.append("mimetype: not %s" % C.MEDIATYPES[".epub"])
+        else:
+            epub = C(fn=fn)
+            zf = epub.zipfile
+            infos = zf.infolist()
+            names = set(info.filename for info in infos if not info.is_dir())
+            if len(infos) == 0 or infos[0].filename != "mimetype":
+                result.errors.append("mimetype: not the first entry in the zip")
+            elif infos[0].compress_type != zipfile.ZIP_STORED:
+                result.errors.append("mimetype: compressed (must be stored)")
+            elif zf.read("mimetype") != C.MEDIATYPES[".epub"].encode("ascii"):
+                result.errors.append("mimetype: not %s" % C.MEDIATYPES[".epub"])
+
+        def open_member(name):
+            if zf is not None:
+                return zf.open(name)
+            return open(os.path.join(fn, name), "rb")
+
+        # -- container and OPF --
+        opf = None
+        if "META-INF/container.xml" not in names:
+            result.errors.append("META-INF/container.xml: file not found")
+        else:
+            try:
+                if zf is not None:
+                    opf = epub.get_opf()
+                else:
+                    opf_fn = C.get_opf_fn(fn)
+                    if opf_fn is not None:
+                        opf = XML(fn=opf_fn)
+            except KeyError as exc:
+                result.errors.append("META-INF/container.xml: rootfile %s" % exc)
+            except etree.XMLSyntaxError as exc:
+                result.errors.append("container or OPF not well-formed: %s" % exc)
+            except OSError as exc:
+                result.errors.append("OPF not found: %s" % exc)
+            if opf is None and len(result.errors) == 0:
+                result.errors.append("META-INF/container.xml: no rootfile for the OPF")
+
+        if opf is not None:
+            opf_name = os.path.relpath(opf.fn, fn).replace("\\", "/")
+            opf_dir = posixpath.dirname(opf_name)
+
+            # -- manifest vs. package members --
+            items = {}  # id => member name
+            media_types = {}  # member name => media-type
+            for item in opf.xpath(opf.root, "opf:manifest/opf:item", namespaces=NS):
+                item_id = item.get("id")
+                name = posixpath.normpath(
+                    posixpath.join(opf_dir, URL(item.get("href")).path)
+                )
+                if item_id in items:
+                    result.errors.append(
+                        "%s: duplicate manifest id %r" % (opf_name, item_id)
+                    )
+                items[item_id] = name
+                media_types[name] = item.get("media-type") or ""
+                if name not in names:
+                    result.errors.append(
+                        "%s: manifest item %r not found: %s" % (opf_name, item_id, name)
+                    )
+            for name in sorted(names - set(media_types) - {"mimetype", opf_name}):
+                if not name.startswith("META-INF/"):
+                    result.warnings.append("%s: file not in the manifest" % name)
+
+            # -- spine --
+            for itemref in opf.xpath(opf.root, "opf:spine/opf:itemref", namespaces=NS):
+                if itemref.get("idref") not in items:
+                    result.errors.append(
+                        "%s: spine itemref idref=%r not in the manifest"
+                        % (opf_name, itemref.get("idref"))
+                    )
+
+            # -- content documents: ids and references, streamed --
+            doc_ids = {}  # member name => set of ids
+            references = []  # (member name, attribute name, reference value)
+            for name in sorted(
+                name
+                for name, media_type in media_types.items()
+                if "html" in media_type and name in names
+            ):
+                ids = doc_ids[name] = set()
+                try:
+                    with open_member(name) as f:
+                        for _, elem in etree.iterparse(f, events=("end",)):
+                            elem_id = elem.get("id")
+                            if elem_id is not None:
+                                if elem_id in ids:
+                                    result.errors.append(
+                                        '%s: duplicate id="%s"' % (name, elem_id)
+                                    )
+                                ids.add(elem_id)
+                            if elem.tag in C.PREFLIGHT_HREF_TAGS:
+                                references.append((name, "href", elem.get("href")))
+                            elif elem.tag == "{http://www.w3.org/2000/svg}image":
+                                references.append(
+                                    (
+                                        name,
+                                        "href",
+                                        elem.get("{http://www.w3.org/1999/xlink}href"),
+                                    )
+                                )
+                            if elem.get("src") is not None:
+                                references.append((name, "src", elem.get("src")))
+                            elem.clear(keep_tail=True)
+                except etree.XMLSyntaxError as exc:
+                    result.errors.append("%s: not well-formed: %s" % (name, exc))
+
+            for name, attr, value in references:
+                if value is None:
+                    continue
+                url = URL(value)
+                if url.scheme not in ["", "file"]:
+                    continue
+                if url.path:
+                    target = posixpath.normpath(
+                        posixpath.join(posixpath.dirname(name), url.path)
+                    )
+                else:
+                    target = name
+                if target not in names:
+                    if attr == "src":
+                        result.errors.append(
+                            "%s: missing resource: %s" % (name, target)
+                        )
+                    else:
+                        result.errors.append(
+                            "%s: link target file not found: %s" % (name, target)
+                        )
+                elif target not in media_types:
+                    result.errors.append(
+                        "%s: link target not in the manifest: %s" % (name, target)
+                    )
+                elif url.fragment and target in doc_ids:
+                    if url.fragment not in doc_ids[target]:
+                        result.errors.append(
+                            '%s: link target id="%s" not found in %s'
+                            % (name, url.fragment, target)
+                        )
+
+        if zf is not None:
+            epub.close()
+
+        log.info(
+            "preflight %s: %d errors, %d warnings (%.3f sec)"
+            % (fn, len(result.errors), len(result.warnings), time.time() - start_time)
+        )
+        if reportfn is not None:
+            with open(reportfn, "w", encoding="utf-8") as f:
+                for message in result.errors:
+                    f.write("ERROR: %s\n" % message)
+                for message in result.warnings:
+                    f.write("WARNING: %s\n" % message)
+            result.reportfn = reportfn
+        return result
+
     def ace(self, zip=False):
         """use DAISY Ace to validate the epub for accessibility"""
         node = os.environ.get("node") or "node"
@@ -95,47 +294,99 @@ class EPUB(ZIP, Source):
         opf = XML(root=self.zipfile.read(zf_path), fn=os.path.join(self.fn, zf_path))
         return opf
 
-    def documents(self, path=None, opf=None, **params):
+    def opf_index(self, opf=None):
+        """
+        Parse the OPF once and index its manifest, so that items can be looked up without
+        re-reading the OPF or running XPath over the manifest. Returns a Dict with
+            opf         : the OPF XML document
+            manifest    : the opf:item elements, in manifest order
+            ids         : manifest item id => opf:item element
+            zf_paths    : manifest item id => the path of the item in the zip file
+        The index of the EPUB's own OPF is cached; a given opf is indexed each time.
+        """
+        if opf is None and self.__opf_index is not None:
+            return self.__opf_index
+        index = Dict(opf=opf or self.get_opf(), manifest=[], ids={}, zf_paths={})
+        for item in index.opf.xpath(
+            index.opf.root, "opf:manifest/opf:item", namespaces=NS
+        ):
+            index.manifest.append(item)
+            if item.get("id") is not None:
+                index.ids[item.get("id")] = item
+                index.zf_paths[item.get("id")] = self.zf_path(
+                    index.opf, item.get("href")
+                )
+        if opf is None:
+            self.__opf_index = index
+        return index
+
+    def zf_path(self, opf, href):
+        """the path in the zip file of the given (quoted) href relative to the opf"""
+        return os.path.relpath(
+            os.path.join(os.path.dirname(opf.fn), URL(href).path), self.fn
+        ).replace("\\", "/")
+
+    def extract(self, zf_path, fn):
+        """stream the zip member at zf_path to the file fn, with a bounded buffer"""
+        if not os.path.exists(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with self.zipfile.open(zf_path) as src, open(fn, "wb") as dest:
+            shutil.copyfileobj(src, dest, self.BUFFER_SIZE)
+        return fn
+
+    def documents(self, path=None, opf=None, workers=None, **params):
         """return a list of pub:document containing the content in the EPUB
         path = the output path for the documents.
+        workers = the number of threads converting XHTML to documents (default cpu count)
         """
         if path is None:
             path = os.path.dirname(os.path.abspath(self.fn))
-        if opf is None:
-            opf = self.get_opf()
-        docs = []
+        index = self.opf_index(opf=opf)
         # build docs from the spine so that they're in the correct order
-        for itemref in opf.xpath(opf.root, "opf:spine/opf:itemref", namespaces=NS):
-            href = opf.find(
-                opf.root,
-                "opf:manifest/opf:item[@id='%s']/@href" % itemref.get("idref"),
-                namespaces=NS,
-            )
-            zf_path = os.path.relpath(
-                os.path.join(os.path.dirname(opf.fn), href), self.fn
-            ).replace("\\", "/")
-            html = HTML(root=self.zipfile.read(zf_path), fn=os.path.join(path, href))
-            docpath = os.path.join(path, os.path.dirname(href)).rstrip("/")
-            fn = self.clean_filename(
-                os.path.join(docpath, os.path.splitext(html.basename)[0] + ".xml")
+        spine_items = []
+        for itemref in index.opf.xpath(
+            index.opf.root, "opf:spine/opf:itemref", namespaces=NS
+        ):
+            item = index.ids.get(itemref.get("idref"))
+            if item is None:
+                log.warning("spine itemref not in manifest: %r" % itemref.attrib)
+                continue
+            spine_items.append(
+                (item.get("href"), index.zf_paths[itemref.get("idref")], path)
             )
-            doc = html.document(fn=fn)
-            docs.append(doc)
+        # lxml releases the GIL while parsing and transforming, so threads are enough.
+        pool = ThreadPool(processes=workers)
+        try:
+            docs = pool.map(self.spine_document, spine_items, chunksize=1)
+        finally:
+            pool.close()
         return docs
 
-    def images(self):
-        opf = self.get_opf()
+    def spine_document(self, spine_item):
+        """convert the (href, zf_path, path) spine_item to a pub:document"""
+        href, zf_path, path = spine_item
+        html = HTML(root=self.zipfile.read(zf_path), fn=os.path.join(path, href))
+        docpath = os.path.join(path, os.path.dirname(href)).rstrip("/")
+        fn = self.clean_filename(
+            os.path.join(docpath, os.path.splitext(html.basename)[0] + ".xml")
+        )
+        return html.document(fn=fn)
+
+    def images(self, path=None, opf=None):
+        """return a list of the image files in the EPUB, streamed to path
+        path = the output path for the images; by default, a new temporary folder (which
+            the caller is responsible for removing), never the folder of the EPUB itself
+        """
+        if path is None:
+            path = tempfile.mkdtemp(prefix="bkgen-epub-images-")
+        index = self.opf_index(opf=opf)
         images = []
-        for item in opf.xpath(
-            opf.root,
-            "opf:manifest/opf:item[contains(@media-type,'image')]",
-            namespaces=NS,
-        ):
-            zf_path = os.path.relpath(
-                os.path.join(os.path.dirname(opf.fn), item.get("href")), self.fn
-            ).replace("\\", "/")
-            image = File(fn=zf_path, data=self.zipfile.read(zf_path))
-            images.append(image)
+        for item in index.manifest:
+            if "image" not in (item.get("media-type") or ""):
+                continue
+            fn = os.path.join(path, str(URL(item.get("href"))))
+            self.extract(self.zf_path(index.opf, item.get("href")), fn)
+            images.append(File(fn=fn, mediatype=item.get("media-type")))
         return images
 
     def resources(self, path=None, opf=None):
@@ -144,51 +395,43 @@ class EPUB(ZIP, Source):
         """
         if path is None:
             path = os.path.dirname(os.path.abspath(self.fn))
-        if opf is None:
-            opf = self.get_opf()
+        index = self.opf_index(opf=opf)
         res = []
+        skip_mediatypes = [
+            EPUB.MEDIATYPES[k]
+            for k in EPUB.MEDIATYPES.keys()
+            if k in [".ncx", ".xhtml", ".opf", ".epub"]
+        ]
         items = [
             item
-            for item in opf.xpath(opf.root, "opf:manifest/opf:item", namespaces=NS)
-            if item.get("media-type")
-            not in [
-                EPUB.MEDIATYPES[k]
-                for k in EPUB.MEDIATYPES.keys()
-                if k in [".ncx", ".xhtml", ".opf", ".epub"]
-            ]
+            for item in index.manifest
+            if item.get("media-type") not in skip_mediatypes
         ]
         found_cover = False
         for item in items:
             href = str(URL(item.get("href")))
-            zf_path = os.path.relpath(
-                os.path.join(os.path.dirname(opf.fn), href), self.fn
-            ).replace("\\", "/")
             fn = os.path.join(path, href)
-            fd = self.zipfile.read(zf_path)
+            self.extract(self.zf_path(index.opf, href), fn)
             f = File(fn=fn, mediatype=item.get("media-type"))
             if "cover-image" in (item.get("properties") or ""):
                 f["class"] = "cover-digital"
                 found_cover = True
-            f.write(data=fd)
             res.append(f)
 
         if found_cover is False:
             # look in the metadata block
-            cover_id = opf.find(
-                opf.root, "opf:metadata/opf:meta[@name='cover']/@content", namespaces=NS
+            cover_id = index.opf.find(
+                index.opf.root,
+                "opf:metadata/opf:meta[@name='cover']/@content",
+                namespaces=NS,
             )
-            if cover_id is not None:
-                item = opf.find(
-                    opf.root,
-                    "opf:manifest/opf:item[@id='%s']" % cover_id,
-                    namespaces=NS,
-                )
-                if item is not None:
-                    fn = os.path.join(path, str(URL(item.get("href"))))
-                    fns = [f.fn for f in res]
-                    if fn in fns:
-                        f = res[fns.index(fn)]
-                        f["class"] = "cover-digital"
+            item = index.ids.get(cover_id)
+            if item is not None:
+                fn = os.path.join(path, str(URL(item.get("href"))))
+                fns = [f.fn for f in res]
+                if fn in fns:
+                    f = res[fns.index(fn)]
+                    f["class"] = "cover-digital"
 
         return res
 
@@ -200,16 +443,14 @@ class EPUB(ZIP, Source):
             return opf.find(opf.root, "opf:metadata", namespaces=NS)
 
     def stylesheet(self):
-        opf = self.get_opf()
+        from bkgen.css import CSS
+
+        index = self.opf_index()
         css_texts = []
-        for css_item in opf.xpath(
-            opf.root, "//opf:item[@media-type='text/css']", namespaces=NS
-        ):
-            zf_path = os.path.relpath(
-                os.path.join(os.path.dirname(opf.fn), css_item.get("href")), self.fn
-            ).replace("\\", "/")
-            fd = self.zipfile.read(zf_path)
-            css_texts.append(fd.decode("UTF-8"))
+        for item in index.manifest:
+            if item.get("media-type") == "text/css":
+                fd = self.zipfile.read(self.zf_path(index.opf, item.get("href")))
+                css_texts.append(fd.decode("UTF-8"))
         return CSS(text="\n".join(css_texts))
 
     @classmethod
@@ -233,6 +474,7 @@ class EPUB(ZIP, Source):
         zip=True,
         check=True,
         ace=True,
+        preflight=True,
         progress=None,
     ):
         """build EPUB file output; returns EPUB object
@@ -261,6 +503,7 @@ class EPUB(ZIP, Source):
             nav_href    = the relative path to use for the nav file (also ncx)
             nav_title   = the title to display on the nav page
             zip_epub    = if True, zip the EPUB after building
+            preflight   = if True, run the in-process preflight() check before epubcheck
 
         """
         if not os.path.isdir(output_path):
@@ -356,6 +599,13 @@ class EPUB(ZIP, Source):
             result.fn = the_epub.fn
             if progress is not None:
                 progress.report()
+            if preflight is True:
+                report = C.preflight(
+                    the_epub.fn, reportfn=the_epub.fn + ".preflight.txt"
+                )
+                for message in report.errors:
+                    log.error("preflight: %s" % message)
+                result.reports.append({"preflight": report.reportfn})
             if check is True:
                 result.reports.append({"epubcheck": the_epub.check()})
             if ace is True:
@@ -1311,6 +1561,17 @@ if __name__ == "__main__":
         if "check" in sys.argv[1]:
             for fn in sys.argv[2:]:
                 EPUB(fn=fn).check()
+        if "preflight" in sys.argv[1]:
+            # exit with an error status if any EPUB fails, so that CI can fail fast
+            failed = False
+            for fn in sys.argv[2:]:
+                report = EPUB.preflight(fn)
+                for message in report.errors:
+                    print("ERROR: %s: %s" % (fn, message))
+                for message in report.warnings:
+                    print("WARNING: %s: %s" % (fn, message))
+                failed = failed or len(report.errors) > 0
+            sys.exit(failed and 1 or 0)
         if "ace" in sys.argv[1]:
             for fn in sys.argv[2:]:
                 EPUB(fn=fn).ace()
@@ -69,7 +69,10 @@ class ICML(XML, Source):
         """create a CSS stylesheet, using the style definitions in the ICML file."""
         pts_per_em = pts_per_em or self.PTS_PER_EM
         styles = Styles()
-        for style in self.root.xpath("//CharacterStyle | //ParagraphStyle"):
+        index = self.self_index()
+        blocks = {}  # style_block() results by Self, so each style is resolved once
+        table_styles = self.table_paragraph_styles()
+        for style in self.root.iter("CharacterStyle", "ParagraphStyle"):
             clsname = self.classname(style.get("Name"))
             if style.tag == "CharacterStyle":
                 if clsname == "No-character-style":
@@ -81,22 +84,32 @@ class ICML(XML, Source):
                     selector = "p"
                 else:
                     selector = "p." + clsname
-                    if (
-                        len(
-                            self.root.xpath(
-                                '//ParagraphStyleRange[@AppliedParagraphStyle="%s" and .//Table]'
-                                % style.get("Self")
-                            )
-                        )
-                        > 0
-                    ):
+                    if style.get("Self") in table_styles:
                         selector += ", div." + clsname
 
-            styles[selector] = self.style_block(style, pts_per_em=pts_per_em)
+            styles[selector] = self.style_block(
+                style, pts_per_em=pts_per_em, index=index, blocks=blocks
+            )
 
         css = CSS(fn=fn or os.path.splitext(self.fn)[0] + ".css", styles=styles)
         return css
 
+    def self_index(self):
+        """a dict of the elements in the document by their Self attribute (first one wins)"""
+        index = {}
+        for elem in self.root.iter(etree.Element):
+            if elem.get("Self") is not None:
+                index.setdefault(elem.get("Self"), elem)
+        return index
+
+    def table_paragraph_styles(self):
+        """the set of the paragraph styles that are applied to ranges containing Tables"""
+        table_styles = set()
+        for table in self.root.iter("Table"):
+            for psr in table.iterancestors("ParagraphStyleRange"):
+                table_styles.add(psr.get("AppliedParagraphStyle"))
+        return table_styles
+
     @classmethod
     def classname(C, stylename):
         """convert an Indesign style name into an HTML class name"""
@@ -118,21 +131,33 @@ class ICML(XML, Source):
     # its value based on what is there. Work by CSS attributes rather
     # than by ICML properties -- treat the style element as data to query
 
-    def style_block(self, elem, pts_per_em=None):
-        """query style elem and return a style definition block"""
+    def style_block(self, elem, pts_per_em=None, index=None, blocks=None):
+        """query style elem and return a style definition block.
+        index = a self_index() of the document, to look up the BasedOn styles.
+        blocks = a dict in which the style blocks are memoized by Self.
+        """
         pts_per_em = pts_per_em or self.PTS_PER_EM
+        if blocks is not None and elem.get("Self") in blocks:
+            return Dict(**blocks[elem.get("Self")])
         style = Dict()
 
         # inheritance via recursion
         based_on = elem.find("Properties/BasedOn")
         if based_on is not None:
-            based_on_elem = XML.find(elem, "//*[@Self='%s']" % based_on.text)
+            if index is not None:
+                based_on_elem = index.get(based_on.text)
+            else:
+                based_on_elem = XML.find(elem, "//*[@Self='%s']" % based_on.text)
             if based_on_elem is not None:
-                style = self.style_block(based_on_elem, pts_per_em=pts_per_em)
+                style = self.style_block(
+                    based_on_elem, pts_per_em=pts_per_em, index=index, blocks=blocks
+                )
 
         # local definitions will override base definitions
         style.update(**self.style_attribute(elem, pts_per_em=pts_per_em))
 
+        if blocks is not None and elem.get("Self") is not None:
+            blocks[elem.get("Self")] = Dict(**style)
         return style
 
     def include_mixin(self, style, mixin):
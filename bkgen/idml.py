@@ -1,14 +1,17 @@
 import logging
+import multiprocessing as mp
 import os
+import threading
 
 from bl.dict import Dict
 from bl.folder import Folder
 from bl.url import URL
 from bl.zip import ZIP
-from bxml import XML
 from bxml.builder import Builder
+from lxml import etree
 
 from bkgen import NS
+from bkgen.destinations import Destinations
 from bkgen.document import Document
 from bkgen.source import Source
 
@@ -21,6 +24,10 @@ B = Builder(default=NS.html, **{"html": NS.html, "pub": NS.pub})
 class IDML(ZIP, Source):
     NS = ICML.NS
 
+    def __init__(self, fn=None, **args):
+        ZIP.__init__(self, fn=fn, **args)
+        self.__lock = threading.RLock()  # guards the incremental indexing of items
+
     @property
     def basename(self):
         return os.path.splitext(os.path.basename(self.fn))[0]
@@ -56,42 +63,81 @@ class IDML(ZIP, Source):
                 self.__stories.append(icml)
         return self.__stories
 
+    def read(self, src):
+        """the decompressed data of the src member of the package, read once"""
+        if self.__members is None:
+            self.__members = {}
+        if src not in self.__members:
+            self.__members[src] = ZIP.read(self, src)
+        return self.__members[src]
+
     @property
     def items(self):
         """
         Return a dict of items (anything with a Self) in the IDML file.
         Needed to resolve Article components.
         """
+        with self.__lock:
+            while self.index_items() is not None:
+                pass
+            return self.__items
+
+    def item(self, self_id):
+        """
+        Return the item with the given Self, indexing the members of the package only until
+        it is found.
+        """
+        with self.__lock:
+            while (self.__items is None or self_id not in self.__items) and (
+                self.index_items() is not None
+            ):
+                pass
+            return self.__items.get(self_id)
+
+    def index_items(self):
+        """
+        Add the items in the next unindexed .xml member of the package to self.items.
+        Spreads come first, because they have the Article components. The member is parsed
+        incrementally from the zipfile. Return the member name, or None if all are indexed.
+        """
         if self.__items is None:
-            d = Dict()
-            for rp in [
-                rp
-                for rp in self.zipfile.namelist()
-                if os.path.splitext(rp)[-1].lower() == ".xml"
-            ]:
-                x = XML(root=self.read(rp))
-                for item in x.root.xpath(
-                    "//*[@Self] | //idPkg:*[@Self]", namespaces=self.NS
-                ):
-                    if (
-                        item.get("Self") in d
-                        and d[item.get("Self")].attrib != item.attrib
-                    ):
-                        LOG.error(
-                            "%s already in items_dict. %r vs. %r"
-                            % (
-                                item.get("Self"),
-                                d[item.get("Self")].attrib,
-                                item.attrib,
-                            )
-                        )
-                    else:
-                        d[item.get("Self")] = item
-            self.__items = d
-        return self.__items
+            self.__items = Dict()
+            self.__unindexed = sorted(
+                [
+                    rp
+                    for rp in self.zipfile.namelist()
+                    if os.path.splitext(rp)[-1].lower() == ".xml"
+                ],
+                key=lambda rp: not rp.startswith("Spreads/"),
+            )
+        if len(self.__unindexed) == 0:
+            return
+        rp = self.__unindexed.pop(0)
+        d = self.__items
+        with self.zipfile.open(rp) as f:
+            for _, item in etree.iterparse(f, events=("start",)):
+                if item.get("Self") is None:
+                    continue
+                if item.get("Self") in d and d[item.get("Self")].attrib != item.attrib:
+                    LOG.error(
+                        "%s already in items_dict. %r vs. %r"
+                        % (item.get("Self"), d[item.get("Self")].attrib, item.attrib)
+                    )
+                elif item.get("Self") not in d:
+                    d[item.get("Self")] = item
+        return rp
+
+    @property
+    def styles_icml(self):
+        """The Resources/Styles.xml, with the style definitions, parsed once."""
+        if self.__styles_icml is None:
+            self.__styles_icml = ICML(root=self.read("Resources/Styles.xml"))
+        return self.__styles_icml
 
     def styles(self):
-        return ICML(root=self.read("Resources/Styles.xml")).styles()
+        if self.__styles is None:
+            self.__styles = self.styles_icml.styles()
+        return self.__styles
 
     def stylesheet(self, fn=None):
         """return a stylesheet from the .idml file's style definitions"""
@@ -99,103 +145,194 @@ class IDML(ZIP, Source):
             fn = os.path.join(
                 self.output_path, os.path.basename(self.output_path) + ".css"
             )
-        return ICML(root=self.read("Resources/Styles.xml")).stylesheet(fn=fn)
+        return self.styles_icml.stylesheet(fn=fn)
 
-    def document(self, path=None, articles=True, sources=None, **params):
+    def document(
+        self,
+        path=None,
+        articles=True,
+        destinations=None,
+        parallel=False,
+        workers=None,
+        **params,
+    ):
         """return a pub:document with the articles / stories in the .idml file.
         path=None: The path in which the document files are created.
         articles=True: If the .idml file has Articles, use those as guidance;
             otherwise, use the stories directly.
-        sources=None: The collection of source documents
-            (e.g., to resolve hyperlinks in a multi-publication InDesign book).
+        destinations=None: The Destinations index of the source documents (e.g., to
+            resolve hyperlinks in a multi-publication InDesign book), shared by all the
+            files in the book; by default, one is made from self + params['fns'].
+        parallel=False: Whether to convert the articles / stories in a process pool.
+        workers=None: The number of processes in the pool (default cpu count).
         """
         path = path or self.output_path
-        if sources is None:
-            sources = [self]
-            for fn in [fn for fn in (params.get("fns") or []) if fn != self.fn]:
-                sources.append(IDML(fn=fn))
+        if destinations is None:
+            destinations = Destinations(
+                fns=[self.fn]
+                + [fn for fn in (params.get("fns") or []) if fn != self.fn],
+                sources={self.fn: self},
+            )
+        else:
+            destinations.source(self.fn, source=self)
         # Articles or Stories?
         if articles is True and len(self.designmap.root.xpath("//Article")) > 0:
-            doc = self.articles_document(path=path, sources=sources)
+            doc = self.articles_document(
+                path=path, destinations=destinations, parallel=parallel, workers=workers
+            )
         else:
-            doc = self.stories_document(path=path, sources=sources)
+            doc = self.stories_document(
+                path=path, destinations=destinations, parallel=parallel, workers=workers
+            )
         return doc
 
-    def articles_document(self, path=None, sources=None):
+    def articles_document(
+        self, path=None, destinations=None, parallel=False, workers=None
+    ):
         """
         Return a collection of pub:documents built from the InDesign Articles in the
-        .idml file.
+        .idml file. If parallel=True, the articles are converted in a pool of (workers)
+        processes.
         """
         path = path or self.output_path
-        sources = sources or [self]
+        destinations = destinations or Destinations(
+            fns=[self.fn], sources={self.fn: self}
+        )
         doc = Document()
         doc.fn = str(Folder(path) / (os.path.splitext(self.basename)[0] + ".xml"))
         doc_body = doc.find(doc.root, "html:body")
-        for article in self.designmap.root.xpath("//Article"):
-            article_icml = ICML()
-            article_icml.fn = os.path.splitext(doc.fn)[0] + ".icml"
+        icml_fn = os.path.splitext(doc.fn)[0] + ".icml"
+        jobs = [
+            ("article_elements", (index, icml_fn))
+            for index in range(len(self.designmap.root.xpath("//Article")))
+        ]
+        for elems in self.convert_parts(jobs, destinations, parallel, workers):
+            for elem in elems:
+                doc_body.append(elem)
+        return doc
+
+    def article_elements(self, index, icml_fn, destinations=None):
+        """the body elements of the pub:document made from the index-th Article"""
+        article = self.designmap.root.xpath("//Article")[index]
+        article_icml = ICML()
+        article_icml.fn = icml_fn
+        LOG.debug(
+            "article name=%r icml.fn = %r" % (article.get("Name"), article_icml.fn)
+        )
+        for member in article.xpath("ArticleMember"):
+            item = self.item(member.get("ItemRef"))
             LOG.debug(
-                "article name=%r icml.fn = %r" % (article.get("Name"), article_icml.fn)
+                "ItemRef=%r => %r ParentStory=%r"
+                % (member.get("ItemRef"), item.tag, item.get("ParentStory"))
             )
-            for member in article.xpath("ArticleMember"):
-                item = self.items[member.get("ItemRef")]
-                LOG.debug(
-                    "ItemRef=%r => %r ParentStory=%r"
-                    % (member.get("ItemRef"), item.tag, item.get("ParentStory"))
+            for elem in item.xpath("descendant-or-self::*[@ParentStory]"):
+                story_id = elem.get("ParentStory")
+                pkg_story = self.designmap.find(
+                    self.designmap.root,
+                    "//idPkg:Story[contains(@src, '%s')]" % story_id,
+                    namespaces=ICML.NS,
                 )
-                for elem in item.xpath("descendant-or-self::*[@ParentStory]"):
-                    story_id = elem.get("ParentStory")
-                    pkg_story = self.designmap.find(
-                        self.designmap.root,
-                        "//idPkg:Story[contains(@src, '%s')]" % story_id,
-                        namespaces=ICML.NS,
-                    )
-                    # Add the story to the Article document as a section
-                    story_icml = ICML(root=self.read(str(URL(pkg_story.get("src")))))
-                    for story in story_icml.root.xpath("//Story"):
-                        article_icml.root.append(story)
+                # Add the story to the Article document as a section
+                story_icml = ICML(root=self.read(str(URL(pkg_story.get("src")))))
+                for story in story_icml.root.xpath("//Story"):
+                    article_icml.root.append(story)
 
-            article_doc = article_icml.document(
-                srcfn=self.fn, sources=sources, styles=self.styles()
+        article_doc = article_icml.document(
+            srcfn=self.fn, destinations=destinations, styles=self.styles()
+        )
+        for incl in article_doc.xpath(
+            article_doc.root, "//pub:include[@idref]", namespaces=NS
+        ):
+            parent = incl.getparent()
+            incl_pkg = self.designmap.root.find(
+                "idPkg:Story[@src='Stories/Story_%s.xml']" % incl.get("idref"),
+                namespaces=self.NS,
             )
-            for incl in article_doc.xpath(
-                article_doc.root, "//pub:include[@idref]", namespaces=NS
-            ):
-                parent = incl.getparent()
-                incl_pkg = self.designmap.root.find(
-                    "idPkg:Story[@src='Stories/Story_%s.xml']" % incl.get("idref"),
-                    namespaces=self.NS,
+            if incl_pkg is not None:
+                incl_doc = ICML(root=self.read(str(URL(incl_pkg.get("src"))))).document(
+                    fn=self.fn,
+                    srcfn=self.fn,
+                    destinations=destinations,
+                    styles=self.styles(),
                 )
-                if incl_pkg is not None:
-                    incl_doc = ICML(
-                        root=self.read(str(URL(incl_pkg.get("src"))))
-                    ).document(
-                        fn=self.fn, srcfn=self.fn, sources=sources, styles=self.styles()
-                    )
-                    for ch in incl_doc.find(
-                        incl_doc.root, "html:body", namespaces=NS
-                    ).getchildren():
-                        parent.insert(parent.index(incl), ch)
-                    parent.remove(incl)
-
-            for elem in article_doc.xpath(
-                article_doc.root, "html:body/*", namespaces=NS
-            ):
-                doc_body.append(elem)
+                for ch in incl_doc.find(
+                    incl_doc.root, "html:body", namespaces=NS
+                ).getchildren():
+                    parent.insert(parent.index(incl), ch)
+                parent.remove(incl)
 
-        return doc
+        return article_doc.xpath(article_doc.root, "html:body/*", namespaces=NS)
 
-    def stories_document(self, path=None, sources=None):
+    def stories_document(
+        self, path=None, destinations=None, parallel=False, workers=None
+    ):
+        """
+        Return a pub:document with the stories in the .idml file, in designmap order. If
+        parallel=True, the stories are converted in a pool of (workers) processes.
+        """
         path = path or self.output_path
-        sources = sources or [self]
+        destinations = destinations or Destinations(
+            fns=[self.fn], sources={self.fn: self}
+        )
         doc = Document()
         doc.fn = str(Folder(path) / (os.path.splitext(self.basename)[0] + ".xml"))
         doc_body = doc.find(doc.root, "html:body")
         doc_body.text = "\n"
         icml_fn = os.path.splitext(doc.fn)[0] + ".icml"
-        for story in self.designmap.root.xpath("idPkg:Story", namespaces=self.NS):
-            icml = ICML(fn=icml_fn, root=self.read(str(URL(story.get("src")))))
-            idoc = icml.document(srcfn=self.fn, sources=sources, styles=self.styles())
-            for elem in idoc.xpath(idoc.root, "html:body/*", namespaces=NS):
+        jobs = [
+            ("story_elements", (str(URL(story.get("src"))), icml_fn))
+            for story in self.designmap.root.xpath("idPkg:Story", namespaces=self.NS)
+        ]
+        for elems in self.convert_parts(jobs, destinations, parallel, workers):
+            for elem in elems:
                 doc_body.append(elem)
         return doc
+
+    def story_elements(self, src, icml_fn, destinations=None):
+        """the body elements of the pub:document made from the story in src"""
+        icml = ICML(fn=icml_fn, root=self.read(src))
+        idoc = icml.document(
+            srcfn=self.fn, destinations=destinations, styles=self.styles()
+        )
+        return idoc.xpath(idoc.root, "html:body/*", namespaces=NS)
+
+    def convert_parts(self, jobs, destinations, parallel=False, workers=None):
+        """
+        Return the lists of body elements from the (method name, args) jobs, in order.
+        The parts are independent given the destinations index and the styles, so with
+        parallel=True, they are converted in a process pool. The workers are spawned
+        rather than forked, so that they don't inherit locks that another thread of this
+        process may hold: each opens the IDML and builds the index and styles once, and
+        returns the elements serialized.
+        """
+        if parallel is not True or len(jobs) < 2:
+            return [
+                getattr(self, method)(*args, destinations=destinations)
+                for method, args in jobs
+            ]
+        with mp.get_context("spawn").Pool(
+            processes=workers,
+            initializer=init_worker,
+            initargs=(self.fn, destinations.fns),
+        ) as pool:
+            results = pool.map(
+                worker_elements, [(self.fn,) + job for job in jobs], chunksize=1
+            )
+        return [etree.fromstring(data).getchildren() for data in results]
+
+
+WORKER_SOURCES = {}  # IDML fn => (IDML, Destinations) in a conversion process
+
+
+def init_worker(fn, fns):
+    """Set up the IDML source and the Destinations index in a conversion process"""
+    idml = IDML(fn=fn)
+    WORKER_SOURCES[fn] = (idml, Destinations(fns=fns, sources={fn: idml}))
+
+
+def worker_elements(job):
+    """convert one (fn, method name, args) job; return the elements in a serialized body"""
+    fn, method, args = job
+    idml, destinations = WORKER_SOURCES[fn]
+    elems = getattr(idml, method)(*args, destinations=destinations)
+    return etree.tostring(B.html.body(*elems))
@@ -0,0 +1,136 @@
+"""
+A cache of image derivatives (resampled or converted images), shared by the builds that
+produce them. Derivatives are stored in a folder, keyed by the digest of the source image
+data and the parameters of the derivative, so unchanged images are not re-processed from
+one build to the next. Image dimensions are also cached (in memory), so that each distinct
+image is identified only once per build. The cache can be used from several threads.
+
+The cache folder is pruned when an ImageCache is created: the least recently used
+derivatives are removed, so that the folder stays within max_size bytes and no
+derivative is older (since last used) than max_age seconds.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from uuid import uuid4
+
+from bf.image import Image
+
+log = logging.getLogger(__name__)
+
+
+class ImageCache:
+    BUFFER_SIZE = 1024 * 1024
+    MAX_SIZE = 1024 * 1024 * 1024  # 1 GB
+    MAX_AGE = 90 * 24 * 60 * 60  # 90 days
+
+    def __init__(self, path=None, max_size=MAX_SIZE, max_age=MAX_AGE):
+        """
+        path = the folder in which derivatives are cached; if None, nothing is stored
+        max_size, max_age = the bounds on the cache folder (None = unbounded); see prune()
+        """
+        self.path = path
+        self.sizes = {}  # filename => (width, height)
+        self.lock = threading.Lock()
+        self.locks = {}  # key => threading.Lock, so that each key is processed once
+        if self.path is not None and os.path.isdir(self.path):
+            self.prune(max_size=max_size, max_age=max_age)
+
+    def prune(self, max_size=MAX_SIZE, max_age=MAX_AGE):
+        """
+        Remove the least recently used derivatives from the cache folder, until it holds no
+        more than max_size bytes, and any that were last used more than max_age seconds ago.
+        """
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.path)
+            if entry.is_file() and not entry.name.startswith(".")
+        )
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for mtime, entry_size, fn in entries:
+            if (max_size is None or size <= max_size) and (
+                max_age is None or time.time() - mtime <= max_age
+            ):
+                break
+            os.remove(fn)
+            size -= entry_size
+            removed += 1
+        if removed > 0:
+            log.info("pruned %d derivatives from %s" % (removed, self.path))
+
+    def key_lock(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def digest(self, fn):
+        """the sha1 digest of the file data, read with a bounded buffer"""
+        h = hashlib.sha1()
+        with open(fn, "rb") as f:
+            for data in iter(lambda: f.read(self.BUFFER_SIZE), b""):
+                h.update(data)
+        return h.hexdigest()
+
+    def size(self, fn):
+        """(width, height) of the image in fn, identified once"""
+        with self.key_lock(fn):
+            if fn not in self.sizes:
+                self.sizes[fn] = tuple(
+                    int(i) for i in Image(fn=fn).identify(format="%w,%h").split(",")
+                )
+            return self.sizes[fn]
+
+    def derivative(self, srcfn, outfn, **params):
+        """
+        Write the derivative of srcfn with the given GraphicsMagick convert params to
+        outfn (which can be srcfn). If the cache already has it, it is copied from the
+        cache; otherwise it is made and stored. outfn is replaced rather than written in
+        place, so a hardlinked outfn is not modified.
+        """
+        key = (
+            self.digest(srcfn)
+            + "-"
+            + hashlib.sha1(
+                json.dumps(params, sort_keys=True).encode("utf-8")
+            ).hexdigest()[:12]
+            + os.path.splitext(outfn)[-1].lower()
+        )
+        with self.key_lock(key):
+            cachefn = self.path and os.path.join(self.path, key)
+            if cachefn is not None and os.path.exists(cachefn):
+                log.debug("cached: %s => %s" % (srcfn, cachefn))
+                os.utime(cachefn)  # (the mtime is the time of last use, for prune())
+                tmpfn = self.tempfn(outfn)
+                shutil.copyfile(cachefn, tmpfn)
+            else:
+                tmpfn = self.tempfn(outfn)
+                try:
+                    Image(fn=srcfn).convert(outfn=tmpfn, **params)
+                except:
+                    os.remove(tmpfn)
+                    raise
+                if cachefn is not None:
+                    os.makedirs(self.path, exist_ok=True)
+                    shutil.copyfile(tmpfn, cachefn)
+            os.replace(tmpfn, outfn)
+        with self.lock:
+            self.sizes.pop(outfn, None)
+        return outfn
+
+    @classmethod
+    def tempfn(C, fn):
+        """a new temporary file next to fn, with the same extension, created with the
+        default mode of new files (0o666, less the process umask)"""
+        path, ext = os.path.dirname(os.path.abspath(fn)), os.path.splitext(fn)[-1]
+        while True:
+            tmpfn = os.path.join(path, "." + uuid4().hex + ext)
+            try:
+                os.close(os.open(tmpfn, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+                return tmpfn
+            except FileExistsError:
+                pass
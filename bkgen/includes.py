@@ -0,0 +1,127 @@
+"""
+Resolution of <pub:include src="path#id"/> elements. The included source documents are
+parsed once per build and indexed by id, recursive includes are detected rather than
+followed, and the include dependency graph (including file => included files) is recorded,
+so that a build can tell which of its outputs depend on which source files.
+"""
+
+import logging
+import os
+import threading
+from copy import deepcopy
+
+from bl.url import URL
+
+from . import NS
+
+log = logging.getLogger(__name__)
+
+
+class Includes:
+    def __init__(self):
+        self.documents = {}  # fn => Document
+        self.ids = {}  # fn => {id: element}
+        self.graph = {}  # fn => set of the fns that it includes
+        self.lock = threading.RLock()
+
+    @classmethod
+    def src_fn_id(C, fn, src):
+        """(absolute filename, id or None) for an include src, relative to fn"""
+        url = str(URL(src))
+        srcfn = os.path.abspath(os.path.join(os.path.dirname(fn), url.split("#")[0]))
+        srcid = url.split("#")[-1] if "#" in url else None
+        return srcfn, srcid
+
+    def document(self, fn):
+        """the Document in fn, parsed and indexed once"""
+        from .document import Document
+
+        with self.lock:
+            if fn not in self.documents:
+                document = Document(fn=fn)
+                ids = {}
+                for elem in document.root.xpath("//*[@id]"):
+                    ids.setdefault(elem.get("id"), elem)
+                self.documents[fn], self.ids[fn] = document, ids
+            return self.documents[fn]
+
+    def elements(self, srcfn, srcid=None, fn=None, chain=None):
+        """
+        Copies of the elements to include from srcfn: the element with srcid, or the
+        content of the body. fn is the including file, and chain is the list of the
+        (srcfn, srcid) includes that are being resolved, from the outermost; if this
+        include is already in the chain, it is recursive, and None is returned.
+        """
+        if (srcfn, srcid) in (chain or []):
+            log.error(
+                "RECURSIVE INCLUDE: %s%s in %s",
+                srcfn,
+                srcid and "#" + srcid or "",
+                fn,
+            )
+            return
+        document = self.document(srcfn)
+        with self.lock:
+            if fn is not None:
+                self.graph.setdefault(os.path.abspath(fn), set()).add(srcfn)
+            if srcid is not None:
+                elem = self.ids[srcfn].get(srcid)
+                elems = [elem] if elem is not None else []
+            else:
+                elems = document.root.xpath("html:body/*", namespaces=NS)
+            return [deepcopy(elem) for elem in elems]
+
+    def render(self, root, fn, strip=False, chain=None):
+        """
+        Put the included content into the <pub:include> elements in root, which is from
+        fn. Includes in the included content are rendered as well, relative to their own
+        source files. If strip=True, the <pub:include> elements are replaced with their
+        contents.
+        """
+        from .document import Document
+
+        chain = chain or [(os.path.abspath(fn), None)]
+        for incl in root.xpath("descendant-or-self::pub:include", namespaces=NS):
+            # remove existing content from the include
+            incl.text = "\n"
+            for ch in incl.getchildren():
+                incl.remove(ch)
+
+            # fill the include with the included content from the source
+            srcfn, srcid = self.src_fn_id(fn, incl.get("src"))
+            if os.path.exists(srcfn):
+                incl_elems = self.elements(srcfn, srcid, fn=fn, chain=chain)
+                if incl_elems is not None:
+                    if len(incl_elems) == 0:
+                        log.warn("NO ELEMENTS TO INCLUDE: %s", incl.get("src"))
+                    for ie in incl_elems:
+                        incl.append(ie)
+                    for ie in incl_elems:
+                        self.render(
+                            ie, srcfn, strip=strip, chain=chain + [(srcfn, srcid)]
+                        )
+            else:
+                log.error("INCLUDE SRC FILE NOT FOUND: %s", incl.get("src"))
+
+            if strip is True:
+                Document.replace_with_contents(incl)
+        return root
+
+    def dependencies(self, fn):
+        """the set of files that fn includes, directly or indirectly"""
+        deps = set()
+        fns = [os.path.abspath(fn)]
+        with self.lock:
+            while len(fns) > 0:
+                for srcfn in self.graph.get(fns.pop(), []):
+                    if srcfn not in deps:
+                        deps.add(srcfn)
+                        fns.append(srcfn)
+        return deps
+
+    def dependents(self, srcfn):
+        """the set of files that include srcfn, directly or indirectly"""
+        srcfn = os.path.abspath(srcfn)
+        with self.lock:
+            fns = list(self.graph.keys())
+        return {fn for fn in fns if srcfn in self.dependencies(fn)}
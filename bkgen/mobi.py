@@ -4,11 +4,13 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
 import click
 from bf.css import CSS
-from bf.image import Image
 from bl.dict import Dict
 from bl.text import Text
 from bl.url import URL
@@ -17,12 +19,19 @@ from bxml.xml import XML, etree
 from bkgen import NS, config
 from bkgen.epub import EPUB
 from bkgen.html import HTML
+from bkgen.image_cache import ImageCache
 
 log = logging.getLogger(__name__)
 
+# serializes GraphicsMagick work on image files shared between concurrent documents
+IMAGE_LOCK = threading.Lock()
+STYLE_LOCK = threading.Lock()
+
 
 class MOBI(Dict):
     NS = NS
+    # files that the Kindle fixups rewrite, which are copied rather than linked in stage()
+    STAGE_COPY_EXTS = [".htm", ".html", ".xhtml", ".css", ".opf", ".ncx"]
 
     def __init__(self, **args):
         Dict.__init__(self, **args)
@@ -51,8 +60,11 @@ class MOBI(Dict):
         nav_href="nav.html",
         nav_title="Navigation",
         mobi7=False,
+        image_cache=None,
     ):
-        """build MOBI (Kindle ebook) output of the given project"""
+        """build MOBI (Kindle ebook) output of the given project
+        image_cache = an ImageCache for the resampled images (see from_epub)
+        """
 
         from .epub import EPUB
 
@@ -84,6 +96,7 @@ class MOBI(Dict):
             progress=progress,
             mobi7=mobi7,
             result=result,
+            image_cache=image_cache,
         )
         return result
 
@@ -96,37 +109,45 @@ class MOBI(Dict):
         progress=None,
         mobi7=False,
         result=None,
+        link=None,
+        image_cache=None,
     ):
+        """
+        Build the .mobi from the EPUB files in epub_path. If a separate build_path is
+        given, the files are staged there first; with link=True, files that the Kindle
+        fixups don't rewrite (images, fonts) are hardlinked rather than copied. link
+        defaults to True unless there is a before_compile hook, which could modify the
+        staged files in place; if both are given, the staged files are unlinked (given
+        their own copies) before the hook is called.
+        image_cache = an ImageCache with a folder in which the resampled images are kept,
+        so that unchanged images are not resampled on every build; by default, nothing is
+        kept between builds.
+        """
         if mobi_name is None:
             mobi_name = EPUB.epub_name_from_path(build_path)
 
         mobifn = self.mobi_fn(build_path, mobi_name=mobi_name)
 
         result = result or {"reports": []}
-        if build_path is not None and os.path.normpath(build_path) != os.path.normpath(
-            epub_path
-        ):
-            # copy the files from the epub_path to the build_path
-            if os.path.exists(build_path):
-                shutil.rmtree(build_path)
-            shutil.copytree(epub_path, build_path)
+        if link is None:
+            link = before_compile is None
+        staged = build_path is not None and os.path.normpath(
+            build_path
+        ) != os.path.normpath(epub_path)
+        if staged is True:
+            # stage the files from the epub_path in the build_path
+            self.stage(epub_path, build_path, link=link)
         else:
             build_path = epub_path
 
         opffn = EPUB.get_opf_fn(build_path)
-        self.strip_header_elements(build_path, opffn)
-
-        self.remove_display_none(opffn)
-        self.remove_details(opffn)
-
-        # == MOBI 7 adjustments (for Amazon.com page previewer, primarily) ==
-        if mobi7 is True:
-            self.move_anchors_before_paragraphs(build_path, opffn)
-            self.direct_styles(opffn)
-            self.size_images(opffn)
-            self.list_style_type_none_divs(opffn)
+        self.kindle_fixups(opffn, mobi7=mobi7, image_cache=image_cache)
 
         if before_compile is not None:
+            if staged is True and link is True:
+                for dirpath, dirnames, filenames in os.walk(build_path):
+                    for filename in filenames:
+                        self.unlink_staged(os.path.join(dirpath, filename))
             before_compile(build_path)
 
         if progress is not None:
@@ -142,6 +163,121 @@ class MOBI(Dict):
 
         return result
 
+    @classmethod
+    def stage(C, epub_path, build_path, link=True):
+        """
+        Stage the files in epub_path to build_path for the Kindle fixups. The files that
+        the fixups rewrite (STAGE_COPY_EXTS) are copied; with link=True, other files are
+        hardlinked where the filesystem allows it, and copied otherwise. A staged file
+        must be passed to unlink_staged() before it is modified in place (copy-on-write).
+        """
+        if os.path.exists(build_path):
+            shutil.rmtree(build_path)
+        if link is True:
+            shutil.copytree(epub_path, build_path, copy_function=C.stage_file)
+        else:
+            shutil.copytree(epub_path, build_path)
+
+    @classmethod
+    def stage_file(C, srcfn, fn):
+        if os.path.splitext(srcfn)[-1].lower() not in C.STAGE_COPY_EXTS:
+            try:
+                os.link(srcfn, fn)
+                return fn
+            except OSError:
+                pass  # cross-device or not supported by the filesystem
+        return shutil.copy2(srcfn, fn)
+
+    @classmethod
+    def unlink_staged(C, fn):
+        """replace a hardlinked (staged) file with its own copy, so it can be modified"""
+        if os.path.exists(fn) and os.stat(fn).st_nlink > 1:
+            tmpfn = fn + ".tmp"
+            shutil.copy2(fn, tmpfn)
+            os.replace(tmpfn, fn)
+
+    def kindle_fixups(self, opffn, mobi7=False, workers=None, image_cache=None):
+        """
+        Apply the Kindle fixups to the html documents in the opf manifest. The fixups are
+        a pipeline of per-document transforms, so that each document is parsed and
+        written once; the documents are processed in a thread pool (workers threads).
+        Images are resampled after the documents, using image_cache (an ImageCache).
+        """
+        image_requests = {}
+        image_cache = image_cache or ImageCache()
+        transforms = [
+            # (transform, whether to apply it to the nav document)
+            (self.html_strip_header_elements, True),
+            (self.html_remove_display_none, False),
+            (self.html_remove_details, False),
+        ]
+        # == MOBI 7 adjustments (for Amazon.com page previewer, primarily) ==
+        if mobi7 is True:
+            transforms += [
+                (self.html_move_anchors_before_paragraphs, True),
+                (partial(self.html_direct_styles, style_cache=Dict()), False),
+                (
+                    partial(
+                        self.html_size_images,
+                        requests=image_requests,
+                        cache=image_cache,
+                    ),
+                    True,
+                ),
+                (self.html_list_style_type_none_divs, False),
+            ]
+        self.transform_html(opffn, transforms, workers=workers)
+        self.resample_images(image_requests, image_cache, workers=workers)
+        self.remove_display_none_css(opffn)
+
+    @classmethod
+    def html_items(C, opffn):
+        """the html documents in the opf manifest, as a list of (filename, is_nav)"""
+        opf = XML(fn=opffn)
+        return [
+            (
+                os.path.join(os.path.dirname(opffn), str(URL(item.get("href")))),
+                item.get("properties") == "nav",
+            )
+            for item in opf.root.xpath(
+                """
+                opf:manifest/opf:item[
+                    contains(@media-type, 'html') 
+                    or substring(@href, string-length(@href) - 3) = 'html'
+                ]
+                """,
+                namespaces=C.NS,
+            )
+        ]
+
+    @classmethod
+    def transform_html(C, opffn, transforms, workers=None):
+        """
+        Apply the given transforms to each html document in the opf manifest, parsing
+        and writing each document once.
+        transforms = a list of (transform, include_nav), where transform(h) modifies the
+            HTML document h in place, and include_nav says whether to apply it to the nav.
+        workers = the number of threads processing documents (default cpu count)
+        """
+        pool = ThreadPool(processes=workers)
+        try:
+            pool.map(
+                lambda html_item: C.transform_html_document(*html_item, transforms),
+                C.html_items(opffn),
+                chunksize=1,
+            )
+        finally:
+            pool.close()
+
+    @classmethod
+    def transform_html_document(C, fn, is_nav, transforms):
+        h = HTML(fn=fn)
+        for transform, include_nav in transforms:
+            if include_nav is True or is_nav is False:
+                transform(h)
+        C.unlink_staged(h.fn)
+        h.write()
+
     @classmethod
     def move_anchors_before_paragraphs(C, build_path, opffn):
         """
@@ -149,286 +285,290 @@ class MOBI(Dict):
         before the containing paragraph so that the
         paragraph formatting can be displayed properly.
         """
-        opf = XML(fn=opffn)
-        n = 0
-        for item in opf.root.xpath(
-            "opf:manifest/opf:item[contains(@media-type, 'html')]", namespaces=C.NS
-        ):
-            x = XML(fn=os.path.join(build_path, str(URL(item.get("href")))))
-            anchors = [
-                a
-                for a in x.root.xpath("//html:a[@id and not(@href)]", namespaces=C.NS)
-                if len(a.getchildren()) == 0 and a.text in [None, ""]
-            ]
-            for a in anchors:
-                pp = a.xpath("ancestor::html:p", namespaces=C.NS)
-                if len(pp) > 0:
-                    n += 1
-                    p = pp[-1]
-                    parent = p.getparent()
-                    XML.remove(a, leave_tail=True)
-                    a.tail = ""
-                    parent.insert(parent.index(p), a)
-            x.write()
+        C.transform_html(opffn, [(C.html_move_anchors_before_paragraphs, True)])
+
+    @classmethod
+    def html_move_anchors_before_paragraphs(C, h):
+        anchors = [
+            a
+            for a in h.root.xpath("//html:a[@id and not(@href)]", namespaces=C.NS)
+            if len(a.getchildren()) == 0 and a.text in [None, ""]
+        ]
+        for a in anchors:
+            pp = a.xpath("ancestor::html:p", namespaces=C.NS)
+            if len(pp) > 0:
+                p = pp[-1]
+                parent = p.getparent()
+                XML.remove(a, leave_tail=True)
+                a.tail = ""
+                parent.insert(parent.index(p), a)
 
     @classmethod
     def strip_header_elements(C, build_path, opffn):
         """Kindle has trouble with header elements, so we just have to strip them."""
-        opf = XML(fn=opffn)
-        for item in opf.root.xpath(
-            "opf:manifest/opf:item[contains(@media-type, 'html')]", namespaces=C.NS
-        ):
-            h = HTML(fn=os.path.join(build_path, str(URL(item.get("href")))))
-            for header in h.xpath(h.root, "//html:header"):
-                HTML.replace_with_contents(header)
-            h.write()
+        C.transform_html(opffn, [(C.html_strip_header_elements, True)])
 
-    def size_images(self, opffn):
+    @classmethod
+    def html_strip_header_elements(C, h):
+        for header in h.xpath(h.root, "//html:header"):
+            HTML.replace_with_contents(header)
+
+    def size_images(self, opffn, image_cache=None, workers=None):
         """
         Resample images to the width / height specified in the img tag,
         and remove those size attributes
         """
-        opf = XML(fn=opffn)
-        for item in [
-            item
-            for item in opf.root.xpath("//opf:manifest/opf:item", namespaces=self.NS)
-            if item.get("href")[-4:].lower() == "html"
-        ]:
-            x = XML(os.path.join(os.path.dirname(opffn), str(URL(item.get("href")))))
-            for img in x.root.xpath(
-                "//html:img[@width or @height or @style]", namespaces=self.NS
-            ):
-                srcfn = os.path.join(os.path.dirname(x.fn), str(URL(img.get("src"))))
-                if os.path.splitext(srcfn)[-1] in [".svg"]:
-                    continue
-                w, h = [
-                    int(i) for i in Image(fn=srcfn).identify(format="%w,%h").split(",")
+        requests = {}
+        cache = image_cache or ImageCache()
+        self.transform_html(
+            opffn,
+            [(partial(self.html_size_images, requests=requests, cache=cache), True)],
+            workers=workers,
+        )
+        self.resample_images(requests, cache, workers=workers)
+
+    def html_size_images(self, x, requests=None, cache=None):
+        """
+        Remove the size attributes from the img tags in x, and record in requests
+        (srcfn => (width, height)) the images that are to be resampled. Images are
+        resampled afterwards with resample_images(), once each, to the smallest geometry
+        that any document requests.
+        """
+        cache = cache or ImageCache()
+        for img in x.root.xpath(
+            "//html:img[@width or @height or @style]", namespaces=self.NS
+        ):
+            srcfn = os.path.join(os.path.dirname(x.fn), str(URL(img.get("src"))))
+            if os.path.splitext(srcfn)[-1] in [".svg"]:
+                continue
+            w, h = cache.size(srcfn)
+            width, height = w, h
+            styles = {
+                k: v
+                for k, v in [
+                    s.strip().split(":")
+                    for s in (img.get("style") or "").split(";")
+                    if s.strip() != ""
                 ]
-                width, height = w, h
-                styles = {
-                    k: v
-                    for k, v in [
-                        s.strip().split(":")
-                        for s in (img.get("style") or "").split(";")
-                        if s.strip() != ""
-                    ]
-                }
-                log.debug(img.attrib)
-                log.debug(styles)
-                if img.get("width") is not None:
-                    width = int(
-                        re.sub(r"\D", "", img.attrib.pop("width"))
-                    )  # treat as pixels
-                    if img.get("height") is None:
-                        height = int(h * (width / w))
-                elif styles.get("width") is not None:
-                    vv = [
-                        i
-                        for i in re.split(r"([a-z%]+)", styles.get("width"))
-                        if i != ""
-                    ]
-                    if len(vv) == 2:
-                        width, unit = vv
-                        if unit in CSS.units.keys():
-                            width = int(
-                                (float(width) * CSS.units[unit]).asUnit(CSS.px) / CSS.px
-                            )
-                            height = int(height * width / w)
-                            styles.pop("width")
-                if img.get("height") is not None:
-                    height = int(
-                        re.sub(r"\D", "", img.attrib.pop("height"))
-                    )  # treat as pixels
-                    if img.get("width") is None:
-                        width = int(w * (height / h))
-                elif styles.get("height") is not None:
-                    vv = [
-                        i
-                        for i in re.split(r"([a-z%]+)", styles.get("height"))
-                        if i != ""
-                    ]
-                    if len(vv) == 2:
-                        height, unit = vv
-                        if unit in CSS.units.keys():
-                            height = int(
-                                (float(height) * CSS.units[unit]).asUnit(CSS.px)
-                                / CSS.px
-                            )
-                            width = int(width * height / h)
-                            styles.pop("height")
-                log.debug("%d x %d\t%d x %d" % (w, h, width, height))
-                image = Image(fn=srcfn)
-                if width < w and height < h:
-                    try:
-                        image.convert(
-                            outfn=srcfn, resize="%dx%d>" % (width, height), sharpen="1"
+            }
+            log.debug(img.attrib)
+            log.debug(styles)
+            if img.get("width") is not None:
+                width = int(
+                    re.sub(r"\D", "", img.attrib.pop("width"))
+                )  # treat as pixels
+                if img.get("height") is None:
+                    height = int(h * (width / w))
+            elif styles.get("width") is not None:
+                vv = [i for i in re.split(r"([a-z%]+)", styles.get("width")) if i != ""]
+                if len(vv) == 2:
+                    width, unit = vv
+                    if unit in CSS.units.keys():
+                        width = int(
+                            (float(width) * CSS.units[unit]).asUnit(CSS.px) / CSS.px
                         )
-                        log.debug(
-                            "%dx%d\t%dx%d\t%s"
-                            % (
-                                w,
-                                h,
-                                width,
-                                height,
-                                os.path.relpath(srcfn, os.path.dirname(opffn)),
-                            )
-                        )
-                    except:
-                        log.error(
-                            "image %s: %s"
-                            % (image.relpath(opf.path), sys.exc_info()[1])
+                        height = int(height * width / w)
+                        styles.pop("width")
+            if img.get("height") is not None:
+                height = int(
+                    re.sub(r"\D", "", img.attrib.pop("height"))
+                )  # treat as pixels
+                if img.get("width") is None:
+                    width = int(w * (height / h))
+            elif styles.get("height") is not None:
+                vv = [
+                    i for i in re.split(r"([a-z%]+)", styles.get("height")) if i != ""
+                ]
+                if len(vv) == 2:
+                    height, unit = vv
+                    if unit in CSS.units.keys():
+                        height = int(
+                            (float(height) * CSS.units[unit]).asUnit(CSS.px) / CSS.px
                         )
-                img.set("style", ";".join("%s:%s" % (k, v) for k, v in styles.items()))
-            x.write(canonicalized=False)
+                        width = int(width * height / h)
+                        styles.pop("height")
+            log.debug("%d x %d\t%d x %d" % (w, h, width, height))
+            if width < w and height < h and requests is not None:
+                # documents are processed concurrently, and an image can be used in several
+                with IMAGE_LOCK:
+                    if srcfn in requests:
+                        width = min(width, requests[srcfn][0])
+                        height = min(height, requests[srcfn][1])
+                    requests[srcfn] = (width, height)
+            img.set("style", ";".join("%s:%s" % (k, v) for k, v in styles.items()))
+
+    def resample_images(self, requests, cache, workers=None):
+        """
+        Resample the images in requests (srcfn => (width, height)) in a thread pool,
+        using the cache of derivatives so that unchanged images are not re-processed.
+        """
+        if len(requests) == 0:
+            return
+        with ThreadPool(processes=workers) as pool:
+            pool.starmap(
+                partial(self.resample_image, cache=cache),
+                sorted(requests.items()),
+            )
+
+    def resample_image(self, srcfn, geometry, cache=None):
+        width, height = geometry
+        try:
+            (cache or ImageCache()).derivative(
+                srcfn, srcfn, resize="%dx%d>" % (width, height), sharpen="1"
+            )
+            log.debug("%dx%d\t%s" % (width, height, srcfn))
+        except:
+            log.error("image %s: %s" % (srcfn, sys.exc_info()[1]))
 
-    def direct_styles(self, opffn):
+    def direct_styles(self, opffn, workers=None):
         """create direct styles for stylesheet elements that some Kindle readers don't support:
         * floats: Kindle iOS
         """
-        opf = XML(fn=opffn)
-        for item in [
-            item
-            for item in opf.root.xpath(
-                """
-                //opf:manifest/opf:item[
-                    not(@properties='nav') 
-                    and (@media-type='text/html' or @media-type='application/xhtml+xml')
-                ]
-                """,
-                namespaces=self.NS,
-            )
-        ]:
-            h = HTML(
-                fn=os.path.join(os.path.dirname(opffn), str(URL(item.get("href"))))
+        self.transform_html(
+            opffn,
+            [(partial(self.html_direct_styles, style_cache=Dict()), False)],
+            workers=workers,
+        )
+
+    def html_direct_styles(self, h, style_cache=None):
+        """
+        Apply the direct styles to the elements in h in a single pass. style_cache (a Dict
+        shared by the documents in a build) holds the direct styles of each distinct set
+        of linked stylesheets, with their selectors compiled to XPath once.
+        """
+        log.debug(h.fn)
+        cssfns = [
+            os.path.normpath(os.path.join(h.path, ss.get("href")))
+            for ss in h.xpath(
+                h.root, "html:head/html:link[@rel='stylesheet' and @type='text/css']"
             )
-            log.debug(h.fn)
-            css = CSS.merge_stylesheets(
-                *[
-                    os.path.join(h.path, ss.get("href"))
-                    for ss in h.xpath(
-                        h.root,
-                        "html:head/html:link[@rel='stylesheet' and @type='text/css']",
-                    )
+        ]
+        if len(cssfns) == 0:
+            return
+        elem_styles = {}
+        for xpath, style in self.direct_stylesheet_styles(
+            cssfns, style_cache=style_cache
+        ):
+            for elem in xpath(h.root):
+                elem_styles.setdefault(elem, {})
+                for k, v in style.items():
+                    elem_styles[elem].setdefault(k, v)
+        for elem, direct_styles in elem_styles.items():
+            styles = {
+                k: v
+                for k, v in [
+                    s.strip().split(":")
+                    for s in (elem.get("style") or "").split(";")
+                    if s.strip() != ""
                 ]
+            }
+            for k, v in direct_styles.items():
+                if k not in styles.keys():
+                    styles[k] = v
+            elem.set(
+                "style",
+                ";".join("%s:%s" % (k, v) for k, v in styles.items()) + ";",
             )
-            for sel, style in [
-                [sel, style] for sel, style in css.styles.items() if sel[0] != "@"
-            ]:
-                # floats
-                if style.get("float:") in ["left", "right"]:
-                    xpath = "//" + CSS.selector_to_xpath(sel, xmlns={"html": h.NS.html})
-                    log.debug("%s %r" % (sel, style))
-                    log.debug(xpath)
-                    for elem in h.xpath(h.root, xpath):
-                        styles = {
-                            k: v
-                            for k, v in [
-                                s.strip().split(":")
-                                for s in (elem.get("style") or "").split(";")
-                                if s.strip() != ""
-                            ]
-                        }
-                        if "float" not in styles.keys():
-                            styles["float"] = style.get("float:")
-                        elem.set(
-                            "style",
-                            ";".join("%s:%s" % (k, v) for k, v in styles.items()) + ";",
+            log.debug(elem.attrib)
+
+    def direct_stylesheet_styles(self, cssfns, style_cache=None):
+        """
+        [(compiled XPath, {property: value}), ...] for the direct styles in the merged
+        stylesheets cssfns, cached in style_cache by the set of stylesheets
+        """
+        style_cache = style_cache if style_cache is not None else Dict()
+        key = tuple(cssfns)
+        with STYLE_LOCK:
+            if key not in style_cache:
+                style_cache.setdefault("xpaths", {})
+                css = CSS.merge_stylesheets(*cssfns)
+                styles = []
+                for sel, style in [
+                    [sel, style] for sel, style in css.styles.items() if sel[0] != "@"
+                ]:
+                    # floats
+                    if style.get("float:") in ["left", "right"]:
+                        if sel not in style_cache["xpaths"]:
+                            xpath = "//" + CSS.selector_to_xpath(
+                                sel, xmlns={"html": self.NS.html}
+                            )
+                            log.debug("%s %r" % (sel, style))
+                            log.debug(xpath)
+                            style_cache["xpaths"][sel] = etree.XPath(
+                                xpath, namespaces=self.NS
+                            )
+                        styles.append(
+                            (style_cache["xpaths"][sel], {"float": style.get("float:")})
                         )
-                        log.debug(elem.attrib)
-            h.write()
+                style_cache[key] = styles
+            return style_cache[key]
 
     def list_style_type_none_divs(self, opffn):
         """convert lists with "list-style-type: none" to nested divs."""
-        opf = XML(fn=opffn)
-        for item in [
-            item
-            for item in opf.root.xpath(
-                """
-                //opf:manifest/opf:item[
-                    not(@properties='nav') 
-                    and (@media-type='text/html' 
-                        or @media-type='application/xhtml+xml')
-                ]
-                """,
-                namespaces=self.NS,
+        self.transform_html(opffn, [(self.html_list_style_type_none_divs, False)])
+
+    def html_list_style_type_none_divs(self, h):
+        cssfns = [
+            os.path.join(h.path, ss.get("href"))
+            for ss in h.xpath(
+                h.root, "html:head/html:link[@rel='stylesheet' and @type='text/css']"
             )
+        ]
+        if len(cssfns) == 0:
+            return
+        css = CSS.merge_stylesheets(*cssfns)
+        for sel, style in [
+            [sel, style]
+            for sel, style in css.styles.items()
+            if sel[0] != "@" and style.get("list-style-type:") == "none"
         ]:
-            h = HTML(
-                fn=os.path.join(os.path.dirname(opffn), str(URL(item.get("href"))))
-            )
-            css = CSS.merge_stylesheets(
-                *[
-                    os.path.join(h.path, ss.get("href"))
-                    for ss in h.xpath(
-                        h.root,
-                        "html:head/html:link[@rel='stylesheet' and @type='text/css']",
-                    )
-                ]
-            )
+            xpath = "//" + CSS.selector_to_xpath(sel, xmlns={"html": h.NS.html})
+            log.debug("%s %r" % (sel, style))
+            log.debug(xpath)
+            for elem in h.xpath(h.root, xpath):
+                tag = h.tag_name(elem)
+                elem.tag = "{%(html)s}div" % h.NS
+                elem.set("class", ((elem.get("class") or "") + " " + tag).strip())
+                # also convert <li> direct children to <div>
+                for li in h.xpath(elem, "html:li"):
+                    tag = h.tag_name(li)
+                    li.tag = "{%(html)s}div" % h.NS
+                    li.set("class", ((li.get("class") or "") + " " + tag).strip())
+
+    def remove_display_none(self, opffn):
+        """Kindle doesn't like too much display:none; so remove those elements,
+        and remove the instruction from the stylesheets.
+        Preserve any pagebreaks in the removed content.
+        """
+        self.transform_html(opffn, [(self.html_remove_display_none, False)])
+        self.remove_display_none_css(opffn)
+
+    def html_remove_display_none(self, h):
+        for link in h.xpath(
+            h.root, "html:head/html:link[@rel='stylesheet' and @type='text/css']"
+        ):
+            css = CSS(fn=os.path.join(h.path, link.get("href")))
             for sel, style in [
                 [sel, style]
                 for sel, style in css.styles.items()
-                if sel[0] != "@" and style.get("list-style-type:") == "none"
+                if sel[0] != "@" and style.get("display:") == "none"
             ]:
                 xpath = "//" + CSS.selector_to_xpath(sel, xmlns={"html": h.NS.html})
                 log.debug("%s %r" % (sel, style))
                 log.debug(xpath)
                 for elem in h.xpath(h.root, xpath):
-                    tag = h.tag_name(elem)
-                    elem.tag = "{%(html)s}div" % h.NS
-                    elem.set("class", ((elem.get("class") or "") + " " + tag).strip())
-                    # also convert <li> direct children to <div>
-                    for li in h.xpath(elem, "html:li"):
-                        tag = h.tag_name(li)
-                        li.tag = "{%(html)s}div" % h.NS
-                        li.set("class", ((li.get("class") or "") + " " + tag).strip())
-            h.write()
-
-    def remove_display_none(self, opffn):
-        """Kindle doesn't like too much display:none; so remove those elements,
-        and remove the instruction from the stylesheets.
-        Preserve any pagebreaks in the removed content.
-        """
+                    parent = elem.getparent()
+                    # preserve pagebreaks in the removed content
+                    for pagebreak in h.xpath(
+                        elem, ".//html:span[@epub:type='pagebreak']"
+                    ):
+                        parent.insert(parent.index(elem), pagebreak)
+                    h.remove(elem, leave_tail=True)
+                    log.debug(etree.tounicode(elem, with_tail=False))
+
+    def remove_display_none_css(self, opffn):
+        """remove the display:none instructions from the stylesheets (after the html)"""
         opf = XML(fn=opffn)
-        html_items = [
-            item
-            for item in opf.root.xpath(
-                """
-                //opf:manifest/opf:item[
-                    not(@properties='nav') 
-                    and (@media-type='text/html' or @media-type='application/xhtml+xml')
-                ]
-                """,
-                namespaces=self.NS,
-            )
-        ]
-        for item in html_items:
-            h = HTML(
-                fn=os.path.join(os.path.dirname(opffn), str(URL(item.get("href"))))
-            )
-            for link in h.xpath(
-                h.root, "html:head/html:link[@rel='stylesheet' and @type='text/css']"
-            ):
-                css = CSS(fn=os.path.join(h.path, link.get("href")))
-                for sel, style in [
-                    [sel, style]
-                    for sel, style in css.styles.items()
-                    if sel[0] != "@" and style.get("display:") == "none"
-                ]:
-                    xpath = "//" + CSS.selector_to_xpath(sel, xmlns={"html": h.NS.html})
-                    log.debug("%s %r" % (sel, style))
-                    log.debug(xpath)
-                    for elem in h.xpath(h.root, xpath):
-                        parent = elem.getparent()
-                        # preserve pagebreaks in the removed content
-                        for pagebreak in h.xpath(
-                            elem, ".//html:span[@epub:type='pagebreak']"
-                        ):
-                            parent.insert(parent.index(elem), pagebreak)
-                        h.remove(elem, leave_tail=True)
-                        log.debug(etree.tounicode(elem, with_tail=False))
-            h.write()
-
         for css_item in [
             item
             for item in opf.root.xpath(
@@ -439,6 +579,7 @@ class MOBI(Dict):
             # do string replace -- easiest
             css = Text(fn=os.path.join(opf.path, css_item.get("href")))
             css.text = css.text.resub(r"display:\s*none;?\n?", "")
+            self.unlink_staged(css.fn)
             css.write()
 
     def remove_css_before_after(self, opffn):
@@ -461,30 +602,17 @@ class MOBI(Dict):
                 if "::before" in sel or "::after" in sel
             ]:
                 css.styles.pop(sel)
+            self.unlink_staged(css.fn)
             css.write()
 
     def remove_details(self, opffn):
         """Kindle doesn't like <details> elements; so remove those elements."""
-        opf = XML(fn=opffn)
-        html_items = [
-            item
-            for item in opf.xpath(
-                opf.root,
-                """//opf:manifest/opf:item[
-                    not(@properties='nav') and 
-                    (@media-type='text/html' or @media-type='application/xhtml+xml')
-                ]""",
-                namespaces=self.NS,
-            )
-        ]
-        for item in html_items:
-            html = HTML(
-                fn=os.path.join(os.path.dirname(opffn), str(URL(item.get("href"))))
-            )
-            for details in html.xpath(html.root, "//html:details"):
-                log.info("<details> in %s", html.path)
-                html.remove(details)
-            html.write()
+        self.transform_html(opffn, [(self.html_remove_details, False)])
+
+    def html_remove_details(self, h):
+        for details in h.xpath(h.root, "//html:details"):
+            log.info("<details> in %s", h.path)
+            h.remove(details)
 
     def compile_mobi(self, build_path, opffn, mobifn=None, config=config):
         """generate .mobi file using kindlegen"""
@@ -22,9 +22,6 @@ from glob import glob
 from itertools import chain
 
 import click
-from bf.image import Image
-from bf.pdf import PDF
-from bgs.gs import GS
 from bl.dict import Dict
 from bl.file import File
 from bl.rglob import rglob
@@ -36,12 +33,11 @@ from bxml.builder import Builder
 from bxml.xml import XML, etree
 
 from . import NS, PATH, config, mimetypes
-from .css import CSS
 from .document import Document
 from .epub import EPUB
 from .html import HTML
+from .includes import Includes
 from .metadata import Metadata
-from .mobi import MOBI
 from .source import Source
 
 log = logging.getLogger(__name__)
@@ -130,6 +126,20 @@ class Project(XML, Source):
     def name(self):
         return self.root.get("name")
 
+    @property
+    def footnote_numbering(self):
+        """where footnote numbers restart: "section" (default), "document", or "book",
+        from <pub:project footnote-numbering="...">
+        """
+        return self.root.get("footnote-numbering") or "section"
+
+    @property
+    def keep_ligatures(self):
+        """ligature characters that are not to be replaced in outputs, from
+        <pub:project keep-ligatures="..."> (for example, "ß" for German content)
+        """
+        return self.root.get("keep-ligatures")
+
     @property
     def path(self):
         return os.path.dirname(os.path.abspath(self.fn))
@@ -250,6 +260,8 @@ class Project(XML, Source):
 
     def stylesheet(self):
         """the master .css for this project is the resource class="stylesheet"."""
+        from .css import CSS
+
         csshref = self.find(
             self.root,
             "pub:resources/pub:resource[@class='stylesheet']/@href",
@@ -277,6 +289,8 @@ class Project(XML, Source):
         project stylesheet and edited there. Then when the content stylesheet is re-generated, the
         edits to those styles are not lost.)
         """
+        from .css import CSS
+
         css = self.stylesheet()
         log.debug("href = %r" % href)
         if href is not None:
@@ -480,6 +494,14 @@ class Project(XML, Source):
             manifest_fns = [
                 str(os.path.join(os.path.dirname(fn), entry)) for entry in manifest
             ]
+            if "destinations" not in args and any(
+                os.path.splitext(manifest_fn)[-1].lower() in [".idml", ".icml"]
+                for manifest_fn in manifest_fns
+            ):
+                # an InDesign book: index its hyperlink destinations once for all files
+                from .destinations import Destinations
+
+                args["destinations"] = Destinations(fns=manifest_fns)
             for manifest_fn in manifest_fns:
                 result.sources.append(
                     self.import_source_file(
@@ -534,13 +556,23 @@ class Project(XML, Source):
         ):
             from .idml import IDML
 
-            result.fns += self.import_source(IDML(fn=fn), **args)
+            if args.get("destinations") is not None:
+                # the source that the book's destinations index has (or will have) open
+                source = args["destinations"].source(fn)
+            else:
+                source = IDML(fn=fn)
+            result.fns += self.import_source(source, **args)
 
         # .XML files
         elif content_type == "application/xml" and ext == ".icml":
             from .icml import ICML
 
-            result.fns += self.import_source(ICML(fn=fn), **args)
+            if args.get("destinations") is not None:
+                # the source that the book's destinations index has (or will have) open
+                source = args["destinations"].source(fn)
+            else:
+                source = ICML(fn=fn)
+            result.fns += self.import_source(source, **args)
 
         elif content_type == "application/xml" and ext == ".xml":
             from .document import Document
@@ -604,6 +636,8 @@ class Project(XML, Source):
         metadata = whether to import metadata from the source (default=False)
         **params = passed to the Source.documents(**params) method
         """
+        from .css import CSS
+
         # If the source file is not already in the project folder and copy_to_source_folder is True,
         # copy the source file into the "canonical" source file location for this project.
         # (if it's already in the project folder, don't copy or move it! Just use it where it is.)
@@ -621,7 +655,12 @@ class Project(XML, Source):
         # import the documents, metadata, images, and stylesheet from this source
         fns = []
         if images is True:
-            imgfns = self.import_images(source.images())
+            if isinstance(source, EPUB):
+                # the EPUB's images are extracted to a temporary folder to be imported
+                with tempfile.TemporaryDirectory() as image_path:
+                    imgfns = self.import_images(source.images(path=image_path))
+            else:
+                imgfns = self.import_images(source.images())
             fns += imgfns
         if documents is True:
             docs = source.documents(path=self.content_path, **params)
@@ -800,6 +839,7 @@ class Project(XML, Source):
         """import the image from a local file. Process through GraphicsMagick to ensure clean."""
         # import the image to the project image folder
         from bf.image import Image
+        from bgs.gs import GS
 
         if gs in params:
             gs = params.pop("gs")
@@ -1136,7 +1176,14 @@ class Project(XML, Source):
         doc_stylesheets=True,
         lang=None,
         image_args=None,
+        image_cache=None,
     ):
+        """
+        image_cache = an ImageCache in which the resampled images are kept between builds
+        (by default, nothing is kept)
+        """
+        from .mobi import MOBI
+
         if image_args is None:
             image_args = config.Kindle.images
         mobi_isbn = self.metadata().identifier(id_patterns=["mobi", "ebook", "isbn"])
@@ -1196,6 +1243,7 @@ class Project(XML, Source):
             spine_items=spine_items,
             cover_src=cover_src,
             before_compile=before_compile,
+            image_cache=image_cache,
         )
         if cleanup is True:
             shutil.rmtree(mobi_path, onerror=rmtree_warn)
@@ -1267,6 +1315,9 @@ class Project(XML, Source):
         maxpixels=4e6,
         **image_args,
     ):
+        from bf.image import Image
+        from bf.pdf import PDF
+
         fn = os.path.normpath(os.path.abspath(fn))
         f = File(fn=fn)
         mimetype = mimetypes.guess_type(fn)
@@ -1368,6 +1419,93 @@ class Project(XML, Source):
 
         return outfn
 
+    @property
+    def includes(self):
+        """
+        The Includes resolver of the latest build, with the include dependency graph:
+        which content files include which source files.
+        """
+        if self.__includes is None:
+            self.__includes = Includes()
+        return self.__includes
+
+    def id_index(self, refresh=True):
+        """
+        {id: filename} for the ids in the project's spine documents, so that crossrefs can
+        be resolved between documents. Each document's ids are collected once and collected
+        again when the file has been modified.
+        refresh=False: return the index as it is, once it has been built, without checking
+            the spine files for changes.
+        """
+        if refresh is False and self.__id_index is not None:
+            return self.__id_index
+        if self.__id_files is None:
+            self.__id_files = Dict()  # fn => (mtime, [ids])
+        fns = []
+        for href in self.root.xpath("pub:spine/pub:spineitem/@href", namespaces=NS):
+            fn = os.path.join(self.path, str(URL(href)).split("#")[0])
+            if os.path.exists(fn):
+                fns.append((fn, os.path.getmtime(fn)))
+        if self.__id_index is None or self.__id_index_key != fns:
+            self.__id_index = Dict()
+            for fn, mtime in fns:
+                if self.__id_files.get(fn) is None or self.__id_files[fn][0] != mtime:
+                    self.__id_files[fn] = (mtime, self.file_ids(fn))
+                for id in self.__id_files[fn][1]:
+                    if id not in self.__id_index:
+                        self.__id_index[id] = fn
+            self.__id_index_key = fns
+        return self.__id_index
+
+    @classmethod
+    def file_ids(C, fn):
+        """the ids in the XML file fn, in document order, parsed without holding the tree"""
+        ids = []
+        for event, elem in etree.iterparse(fn, events=("start", "end")):
+            if event == "start":
+                if elem.get("id") is not None:
+                    ids.append(elem.get("id"))
+            else:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        return ids
+
+    def crossref_target(self, src, source_fn=None):
+        """
+        The element in the project that a crossref src (path#id, relative to source_fn,
+        or #id) refers to, or None. The spine files are only checked for changes when the
+        id is not found in the index as it is.
+        """
+        path, id = (["", ""] + str(src).split("#"))[-2:]
+        if path != "" and source_fn is not None:
+            fn = os.path.abspath(os.path.join(os.path.dirname(source_fn), path))
+            return self.crossref_document_ids(fn).get(id)
+        for refresh in [False, True]:
+            fn = self.id_index(refresh=refresh).get(id)
+            elem = self.crossref_document_ids(fn).get(id) if fn is not None else None
+            if elem is not None:
+                return elem
+
+    def crossref_document_ids(self, fn):
+        """
+        {id: element} for the document fn, or {} if it doesn't exist. Each document is
+        loaded and indexed once, and again when it has been modified.
+        """
+        from .converters.document_html import id_index
+
+        if not os.path.exists(fn):
+            return {}
+        if self.__crossref_documents is None:
+            self.__crossref_documents = Dict()  # fn => (mtime, {id: element})
+        mtime = os.path.getmtime(fn)
+        if (
+            self.__crossref_documents.get(fn) is None
+            or self.__crossref_documents[fn][0] != mtime
+        ):
+            self.__crossref_documents[fn] = (mtime, id_index(Document(fn=fn).root))
+        return self.__crossref_documents[fn][1]
+
     def output_spineitems(
         self,
         output_path=None,
@@ -1380,6 +1518,8 @@ class Project(XML, Source):
         conditions="digital",
         image_args=None,
     ):
+        from .css import CSS
+
         log.debug("project.output_spineitems()")
         output_path = output_path or os.path.join(self.path, str(self.output_folder))
         image_args = image_args or {}
@@ -1403,6 +1543,8 @@ class Project(XML, Source):
         outfns = []
         css_fns = glob(os.path.join(self.content_path, "*.css"))
         endnotes = []  # collect endnotes and pass into and out of Document.html()
+        self.__includes = Includes()  # include sources are parsed once per build
+        footnote_counter = Dict(count=0)  # for footnote_numbering="book"
         for spineitem in spineitems:
             split_href = str(URL(spineitem.get("href"))).split("#")
             log.debug(split_href)
@@ -1447,6 +1589,11 @@ class Project(XML, Source):
                     endnotes=endnotes,
                     lang=lang,
                     conditions=conditions,
+                    keep_ligatures=self.keep_ligatures,
+                    footnote_numbering=self.footnote_numbering,
+                    footnote_counter=footnote_counter,
+                    crossref_target=self.crossref_target,
+                    includes=self.includes,
                 )
                 h.fn = outfn
                 h.path = os.path.dirname(os.path.abspath(h.fn))
@@ -1904,6 +2051,8 @@ def import_stylesheets(project_path, filenames):
     """
     Merge the given CSS files into the project stylesheet.
     """
+    from .css import CSS
+
     project = Project.load(project_path)
     css = project.stylesheet()
     css.write()
@@ -0,0 +1,74 @@
+"""
+Check that the streaming DOCX import (DOCX.document(stream=True)) gives the same output as
+the regular import, for each of the given chunk sizes, and that it does not load the
+whole of word/document.xml.
+
+    python -m bkgen.scripts.docx_stream_check [-c CHUNK_SIZE ...] FILE.docx ...
+
+For each file and chunk size, prints "ok" or the first line at which the outputs differ.
+Exits with status 1 if any output differs or word/document.xml was loaded.
+"""
+
+import os
+import sys
+import tempfile
+
+import click
+from lxml import etree
+
+from bkgen.docx import DOCX
+
+
+def output(fn, path, **params):
+    """(the serialized output of importing the .docx file fn to path, the DOCX)"""
+    docx = DOCX(fn=fn)
+    doc = docx.document(
+        fn=os.path.join(path, os.path.splitext(os.path.basename(fn))[0] + ".xml"),
+        **params
+    )
+    return etree.tounicode(doc.root), docx
+
+
+@click.command()
+@click.option(
+    "-c", "--chunk-size", "chunk_sizes", multiple=True, type=int, default=[1, 7, 500]
+)
+@click.argument("fns", nargs=-1, required=True)
+def main(chunk_sizes, fns):
+    failed = False
+    for fn in fns:
+        with tempfile.TemporaryDirectory() as path:
+            expected = output(fn, path)[0].split("\n")
+            for chunk_size in chunk_sizes:
+                result, docx = output(fn, path, stream=True, chunk_size=chunk_size)
+                result = result.split("\n")
+                if "word/document.xml" in docx.xml_cache:
+                    failed = True
+                    print(
+                        "%s (chunk_size=%d): word/document.xml was loaded"
+                        % (fn, chunk_size)
+                    )
+                diffs = [
+                    i
+                    for i in range(max(len(expected), len(result)))
+                    if expected[i : i + 1] != result[i : i + 1]
+                ]
+                if len(diffs) == 0:
+                    print("%s (chunk_size=%d): ok" % (fn, chunk_size))
+                else:
+                    failed = True
+                    print(
+                        "%s (chunk_size=%d): differs at line %d:\n    %r\n    %r"
+                        % (
+                            fn,
+                            chunk_size,
+                            diffs[0] + 1,
+                            "".join(expected[diffs[0] : diffs[0] + 1]),
+                            "".join(result[diffs[0] : diffs[0] + 1]),
+                        )
+                    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Benchmark the conversion of .icml files to pub:documents, with the time spent in each
+post-processing step (icml_document.post_process).
+
+    python -m bkgen.scripts.icml_benchmark [-n REPEAT] FILE.icml ...
+
+For each file, prints the best total conversion time of REPEAT runs, and the seconds spent
+in each post-processing step in that run, slowest first.
+"""
+
+import time
+
+import click
+
+from bkgen.icml import ICML
+
+
+def convert(fn):
+    """(total seconds, {step name: seconds}) for one conversion of the .icml file"""
+    timings = {}
+    start = time.perf_counter()
+    ICML(fn=fn).document(timings=timings)
+    return time.perf_counter() - start, timings
+
+
+@click.command()
+@click.option("-n", "--repeat", default=3, help="runs per file (best is reported)")
+@click.argument("fns", nargs=-1, required=True)
+def main(repeat, fns):
+    for fn in fns:
+        total, timings = min([convert(fn) for i in range(repeat)], key=lambda r: r[0])
+        print(
+            "%s: %.1f ms (post_process %.1f ms)"
+            % (fn, total * 1000, sum(timings.values()) * 1000)
+        )
+        for name, seconds in sorted(timings.items(), key=lambda i: i[1], reverse=True):
+            print("    %8.1f ms  %s" % (seconds * 1000, name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Check that converting an IDML file in a process pool (IDML.document(parallel=True)) gives
+the same output as converting it serially, for each of the given numbers of workers.
+
+    python -m bkgen.scripts.idml_parallel_check [-w WORKERS ...] FILE.idml ...
+
+For each file and number of workers, prints "ok" or the first line at which the outputs
+differ. Exits with status 1 if any output differs.
+"""
+
+import sys
+import tempfile
+
+import click
+from lxml import etree
+
+from bkgen.idml import IDML
+
+
+def output(fn, path, **params):
+    """the serialized output of converting the .idml file fn to path"""
+    doc = IDML(fn=fn).document(path=path, **params)
+    return etree.tounicode(doc.root)
+
+
+@click.command()
+@click.option("-w", "--workers", "workers", multiple=True, type=int, default=[2, 4])
+@click.argument("fns", nargs=-1, required=True)
+def main(workers, fns):
+    failed = False
+    for fn in fns:
+        with tempfile.TemporaryDirectory() as path:
+            expected = output(fn, path).split("\n")
+            for n in workers:
+                result = output(fn, path, parallel=True, workers=n).split("\n")
+                diffs = [
+                    i
+                    for i in range(max(len(expected), len(result)))
+                    if expected[i : i + 1] != result[i : i + 1]
+                ]
+                if len(diffs) == 0:
+                    print("%s (workers=%d): ok" % (fn, n))
+                else:
+                    failed = True
+                    print(
+                        "%s (workers=%d): differs at line %d:\n    %r\n    %r"
+                        % (
+                            fn,
+                            n,
+                            diffs[0] + 1,
+                            "".join(expected[diffs[0] : diffs[0] + 1]),
+                            "".join(result[diffs[0] : diffs[0] + 1]),
+                        )
+                    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Measure the import time of bkgen modules, each in a fresh interpreter (as a bkgen CLI
+invocation or a worker process would import it), using `python -X importtime`.
+
+    python -m bkgen.scripts.import_time [-n REPEAT] [-t TOP] [MODULE ...]
+
+For each module, prints the best total import time of REPEAT runs, and the TOP imports
+that took the longest (cumulative) in that run.
+"""
+
+import re
+import subprocess
+import sys
+
+import click
+
+MODULES = [
+    "bkgen",
+    "bkgen.project",
+    "bkgen.epub",
+    "bkgen.mobi",
+    "bkgen.converters.document_html",
+    "bkgen.converters.document_icml",
+    "bkgen.converters.docx_document",
+]
+
+
+def import_times(module):
+    """[(cumulative microseconds, self microseconds, module name), ...] for one import"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().split("\n")[-1])
+    times = []
+    for line in result.stderr.split("\n"):
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)", line)
+        if match is not None:
+            self_us, cumulative_us, _, name = match.groups()
+            times.append((int(cumulative_us), int(self_us), name))
+    return times
+
+
+@click.command()
+@click.option("-n", "--repeat", default=5, help="runs per module (best is reported)")
+@click.option("-t", "--top", default=10, help="number of slowest imports to list")
+@click.argument("modules", nargs=-1)
+def main(repeat, top, modules):
+    for module in modules or MODULES:
+        try:
+            runs = [import_times(module) for i in range(repeat)]
+        except RuntimeError as exc:
+            print("%s: ERROR: %s" % (module, exc))
+            continue
+        best = min(runs, key=lambda times: times[-1][0])
+        print("%s: %.1f ms" % (module, best[-1][0] / 1000))
+        for cumulative_us, self_us, name in sorted(best, reverse=True)[1 : top + 1]:
+            print(
+                "    %8.1f ms %8.1f ms  %s"
+                % (cumulative_us / 1000, self_us / 1000, name)
+            )
+
+
+if __name__ == "__main__":
+    main()